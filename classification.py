@@ -14,8 +14,11 @@ import lasagne
 import pprint
 from guitar_trans import models
 from guitar_trans import parameters as pm
+from guitar_trans.feature_store import FeatureStore, feature_class_name
+from guitar_trans.dataset import Dataset, BalancedSampler
+from guitar_trans.augmentation import augment_clip
 from lasagne import layers
-from sklearn.metrics import confusion_matrix, precision_score, recall_score, f1_score
+from multiprocessing import Pool
 
 model_dir = "model"
 output_dir = "outputs"
@@ -40,7 +43,68 @@ def save_to_feature_bank(bank, feature, num):
             bank[idx].append(feature)
             return
 
-def load_n_preprocess_input_feature(audio_dir, mc_dir, m_class, sep_direction=False):
+def load_one_input_feature(audio_fp, mc_dir, m_class, sep_direction=False, n_aug=0, aug_seed=0):
+    """
+    Load and preprocess one clip of the dataset, and extract the features of 
+    the clip and of n_aug augmented copies of it.
+
+    Returns
+    -------
+    None if the melody contour is too short, otherwise a list of (direction, 
+    ans_num, cv_num, feature), the clip first, where feature is None if m_class 
+    rejects the clip.
+    """
+    fi = os.path.basename(audio_fp)
+    y, sr = rosa.load(audio_fp, sr=pm.SAMPLING_RATE, mono=True)
+    fn = os.path.splitext(fi)[0]
+    mc = np.loadtxt(mc_dir+'/'+fn+'.MIDI.melody', dtype='float32')
+    
+    ### Preprocess melody contour
+    if len(mc) < 18:
+        print('{} mc length must be larger than 18. (only {}).'.format(fi, len(mc)))
+        return None
+    elif len(mc) < pm.MC_LENGTH:
+        mc = np.pad(mc, (0, pm.MC_LENGTH-len(mc)), 'edge')
+    elif len(mc) > pm.MC_LENGTH:
+        mc = mc[:pm.MC_LENGTH]
+    replace_leading_ending_zeros(mc)
+    
+    ### Classify ascending or descending
+    if sep_direction:
+        if fn.split('_')[0] == pm.HAMM:
+            direction = pm.D_ASCENDING
+        elif fn.split('_')[0] == pm.PULL:
+            direction = pm.D_DESCENDING
+        elif mc[:5].mean() <= mc[-5:].mean():
+            direction = pm.D_ASCENDING
+        else:
+            direction = pm.D_DESCENDING
+        c_class = fn.split('_')[0]
+    else:
+        direction = pm.D_ASCENDING
+        c_class = pm.HAMM if fn.split('_')[0] == pm.PULL else fn.split('_')[0]
+
+    ### Create the answer in a form like [0,0,0,1,0]
+    ans_num = pm.tech_dict[direction][c_class]
+    ans = np.zeros(pm.NUM_CLASS, dtype='int32')
+    ans[ans_num] = 1
+
+    ### Extract feature
+    cv_num = int(fn.split('_')[2])
+    results = [(direction, ans_num, cv_num, m_class.extract_features(y, mc, fn, ans))]
+    for y_aug, mc_aug, fn_aug in augment_clip(y, mc, fn, n_aug, aug_seed):
+        results.append((direction, ans_num, cv_num, m_class.extract_features(y_aug, mc_aug, fn_aug, ans)))
+    return results
+
+def _load_one_job(job):
+    return load_one_input_feature(*job)
+
+def load_n_preprocess_input_feature(audio_dir, mc_dir, m_class, sep_direction=False, n_jobs=1, n_aug=0, aug_seed=0):
+    """
+    Load all clips of audio_dir with n_jobs worker processes, each followed by
+    n_aug augmented copies. Files are loaded in sorted order and augmentations
+    are seeded per clip, so feature_bank is the same for any n_jobs.
+    """
     assert os.path.isdir(audio_dir), \
            "{} is not a directory.".format(audio_dir)
     assert os.path.isdir(mc_dir), \
@@ -59,88 +123,90 @@ def load_n_preprocess_input_feature(audio_dir, mc_dir, m_class, sep_direction=Fa
         for k in feature_bank:
             feature_bank[k] = [[] for _ in pm.cv_list]
         cls_len = { pm.D_ASCENDING: np.zeros(pm.NUM_CLASS, dtype=int) }
-    for root, dirs, files in os.walk(audio_dir):
-        for fi in files:
-            ### Load features
-            if '.wav' in fi:
-                # print('file name: {}'.format(fi))
-                y, sr = rosa.load(os.path.join(root, fi), sr=pm.SAMPLING_RATE, mono=True)
-                fn = os.path.splitext(fi)[0]
-                mc = np.loadtxt(mc_dir+'/'+fn+'.MIDI.melody', dtype='float32')
-                
-                ### Preprocess melody contour
-                if len(mc) < 18:
-                    print('{} mc length must be larger than 18. (only {}).'.format(fi, len(mc)))
-                    continue
-                elif len(mc) < pm.MC_LENGTH:
-                    mc = np.pad(mc, (0, pm.MC_LENGTH-len(mc)), 'edge')
-                elif len(mc) > pm.MC_LENGTH:
-                    mc = mc[:pm.MC_LENGTH]
-                replace_leading_ending_zeros(mc)
-                
-                ### Classify ascending or descending
-                if sep_direction:
-                    if fn.split('_')[0] == pm.HAMM:
-                        direction = pm.D_ASCENDING
-                    elif fn.split('_')[0] == pm.PULL:
-                        direction = pm.D_DESCENDING
-                    elif mc[:5].mean() <= mc[-5:].mean():
-                        direction = pm.D_ASCENDING
-                    else:
-                        direction = pm.D_DESCENDING
-                    c_class = fn.split('_')[0]
-                else:
-                    direction = pm.D_ASCENDING
-                    c_class = pm.HAMM if fn.split('_')[0] == pm.PULL else fn.split('_')[0]
-                bank = feature_bank[direction]
-
-                ### Create the answer in a form like [0,0,0,1,0]
-                ans_num = pm.tech_dict[direction][c_class]
-                cls_len[direction][int(ans_num)] += 1
-                ans = np.zeros(pm.NUM_CLASS, dtype='int32')
-                ans[ans_num] = 1
-
-                ### Extract feature
-                feature = m_class.extract_features(y, mc, fn, ans)
-                if feature is None: continue
-                save_to_feature_bank(bank, feature, int(fn.split('_')[2]))
+    audio_fps = sorted(os.path.join(root, fi) for root, dirs, files in os.walk(audio_dir) 
+                       for fi in files if '.wav' in fi)
+    jobs = [(fp, mc_dir, m_class, sep_direction, n_aug, aug_seed) for fp in audio_fps]
+    if n_jobs > 1:
+        pool = Pool(n_jobs)
+        ### imap keeps the order of jobs; chunks amortize the inter-process overhead
+        res_iter = pool.imap(_load_one_job, jobs, chunksize=max(1, len(jobs) // (n_jobs * 8)))
+    else:
+        pool = None
+        res_iter = (_load_one_job(job) for job in jobs)
+    report_every = max(1, len(jobs) // 20)
+    for i, res in enumerate(res_iter):
+        if (i + 1) % report_every == 0 or i + 1 == len(jobs):
+            print('  Loaded {}/{} files ({:.1f} secs)'.format(i + 1, len(jobs), time.time()-start_time))
+            sys.stdout.flush()
+        if res is None: continue
+        for direction, ans_num, cv_num, feature in res:
+            cls_len[direction][int(ans_num)] += 1
+            if feature is None: continue
+            save_to_feature_bank(feature_bank[direction], feature, cv_num)
+    if pool is not None:
+        pool.close()
+        pool.join()
     print('Totally loaded {} secs.'.format(time.time()-start_time))
     print('Class lengths: {}'.format(cls_len))
     return feature_bank
 
 #=====DATA DISTRIBUTION=====#
 
-def balance_number_of_data(data_list):
-    clss = [[] for i in range(pm.NUM_CLASS)]
-    for dt in data_list:
-        clss[np.argmax(dt[-2])].append(dt)
-    min_len = min([len(c) for c in clss])
-    print('Balance each class to {} data.'.format(min_len))
-    new_data_list = []
-    for c in clss:
-        new_data_list += random.sample(c, min_len)
-    random.shuffle(new_data_list)
-    return new_data_list
+def balance_number_of_data(dataset):
+    ### One fixed balanced subset; Model.train(balance=...) draws a new one every epoch instead
+    sampler = BalancedSampler(dataset)
+    new_dataset = sampler.epoch()
+    print('Balance each class to {} data.'.format(min(len(c) for c in sampler.class_idx if len(c) > 0)))
+    return new_dataset
 
 def get_train_test_feat(feature_bank, idx, balance=False):
-    train_list, test_list = [], []
-    for i in range(len(feature_bank)):
-        if i == idx:
-            test_list += feature_bank[i]
-        else:
-            train_list += feature_bank[i]
+    ### Datasets over the folds of feature_bank; no features are copied
+    test_list = Dataset.from_folds([feature_bank[idx]])
+    train_list = Dataset.from_folds([feature_bank[i] for i in range(len(feature_bank)) if i != idx])
     if balance: 
       train_list = balance_number_of_data(train_list)
-    np.random.shuffle(train_list)
+    ### Not shuffled here: Model.train permutes the data itself, with the order 
+    ### saved in its checkpoints, so the clips must come in a reproducible order
     return train_list, test_list
 
 #=====CLASSIFICATION=====#
 
-def classify(feature_bank, model_name, model_class, param_set, sep_direction=True, test_aug=False):
-    if not os.path.isdir(os.path.join(model_dir, model_name)):
-        os.mkdir(os.path.join(model_dir, model_name))
-    if not os.path.isdir(os.path.join(output_dir, model_name)):
-        os.mkdir(os.path.join(output_dir, model_name))
+def prepare_dirs(model_name):
+    for d in (model_dir, output_dir):
+        if not os.path.isdir(os.path.join(d, model_name)):
+            os.makedirs(os.path.join(d, model_name))
+
+def train_fold(bank, idx, model_name, model_class, param_set, direction_type, test_aug=False, num_epochs=100, 
+               balance=None):
+    """
+    Train a model on all folds of bank but idx and test it on fold idx. With
+    balance ('balanced' or 'weighted'), every epoch trains on a new
+    class-balanced sample of the training folds.
+
+    Returns
+    -------
+    cm: np.ndarray, the confusion matrix of the test fold
+    """
+    model_file = model_name+'_'+str(idx)+'.'+direction_type+'.npz'
+    model_fp = os.path.join(model_dir, model_name, model_file)
+    train_list, test_list = get_train_test_feat(bank, idx, balance=False)
+
+    ### initialize model
+    model = model_class(param_set, model_fp)
+
+    ### train model and save training result
+    model.train(train_list, num_epochs, balance=balance)
+
+    ### test and evaluate
+    npzfile = np.load(model_fp)
+    model.set_param_values(npzfile['params'])
+    if test_aug:
+        return model.test(test_list)
+    origin_idx = [i for i, fn in enumerate(test_list.fns()) if 'aug' not in fn]
+    return model.test(test_list.subset(origin_idx))
+
+def classify(feature_bank, model_name, model_class, param_set, sep_direction=True, test_aug=False, balance=None):
+    prepare_dirs(model_name)
     all_results = {}
     for key in feature_bank:
         direction_type = key if sep_direction else pm.D_MIXED
@@ -148,28 +214,8 @@ def classify(feature_bank, model_name, model_class, param_set, sep_direction=Tru
         bank = feature_bank[key]
         cm_all = np.zeros((pm.NUM_CLASS, pm.NUM_CLASS), dtype=int)
         for idx in range(len(bank)):
-            model_file = model_name+'_'+str(idx)+'.'+direction_type+'.npz'
-            model_fp = os.path.join(model_dir, model_name, model_file)
-            train_list, test_list = get_train_test_feat(bank, idx, balance=False)
-
-            ### initialize model
-            model = model_class(param_set, model_fp)
-
-            ### train model and save training result
-            model.train(train_list, 100)
-
-            ### test and evaluate
-            npzfile = np.load(model_fp)
-            model.set_param_values(npzfile['params'])
-            if test_aug:
-                cm = model.test(test_list)
-            else:
-                origin_test_list = []
-                for t in test_list:
-                    if 'aug' not in t[-1]:
-                        origin_test_list.append(t)
-                cm = model.test(origin_test_list)
-            cm_all += cm
+            cm_all += train_fold(bank, idx, model_name, model_class, param_set, direction_type, test_aug, 
+                                 balance=balance)
         
         
         csv_fn = 'evaluation.' + direction_type + '.csv'
@@ -180,21 +226,57 @@ def classify(feature_bank, model_name, model_class, param_set, sep_direction=Tru
 
 #=====EVALUATION=====#
 
-def eval_scores(cm, direction_type, print_scores=True, save_fp=None):
-    t, p = [], []
-    for i in range(len(cm)):
-        for j in range(len(cm[i])):
-            for _ in range(cm[i][j]):
-                t.append(i)
-                p.append(j)
-    each_p = precision_score(t, p, average=None)
-    each_r = recall_score(t, p, average=None)
-    each_f = f1_score(t, p, average=None)
-    all_p = precision_score(t, p, average='weighted')
-    all_r = recall_score(t, p, average='weighted')
-    all_f = f1_score(t, p, average='weighted')
-
-    final_acc = float(np.sum(np.diagonal(cm))) * 100 / float(np.sum(cm))
+def confusion_scores(cm):
+    """
+    Precision, recall and F1 of every class and their support-weighted
+    averages, computed from confusion matrices cm[..., true, pred] (a single
+    matrix or a stack of them). Undefined ratios (0 / 0) are 0.
+
+    Returns
+    -------
+    each_p, each_r, each_f: np.ndarray, shape=(..., n_class)
+    all_p, all_r, all_f: np.ndarray, shape=(...)
+    acc: np.ndarray, shape=(...), the accuracy
+    """
+    cm = np.asarray(cm, dtype=float)
+    tp = np.diagonal(cm, axis1=-2, axis2=-1)
+    support = cm.sum(axis=-1)
+    n_pred = cm.sum(axis=-2)
+    total = support.sum(axis=-1)
+    safe_div = lambda a, b: np.where(b > 0, a / np.where(b > 0, b, 1), 0.0)
+    each_p = safe_div(tp, n_pred)
+    each_r = safe_div(tp, support)
+    each_f = safe_div(2 * each_p * each_r, each_p + each_r)
+    weights = safe_div(support, total[..., np.newaxis])
+    all_p, all_r, all_f = [(sc * weights).sum(axis=-1) for sc in (each_p, each_r, each_f)]
+    acc = safe_div(tp.sum(axis=-1), total)
+    return each_p, each_r, each_f, all_p, all_r, all_f, acc
+
+def bootstrap_scores(cm, n_bootstrap=1000, ci=95, seed=0):
+    """
+    Bootstrap confidence intervals of the accuracy and the weighted precision,
+    recall and F1: the test samples are resampled with replacement by drawing
+    whole confusion matrices from a multinomial over the cells of cm.
+
+    Returns
+    -------
+    intervals: dict, score name -> (low, high)
+    """
+    cm = np.asarray(cm)
+    total = int(cm.sum())
+    if total == 0:
+        return dict((k, (0.0, 0.0)) for k in ('Accuracy', 'Precision', 'Recall', 'F1'))
+    rng = np.random.RandomState(seed)
+    samples = rng.multinomial(total, cm.ravel() / float(total), size=n_bootstrap).reshape((n_bootstrap,) + cm.shape)
+    _, _, _, all_p, all_r, all_f, acc = confusion_scores(samples)
+    q = [(100 - ci) / 2.0, 100 - (100 - ci) / 2.0]
+    return {'Accuracy': tuple(np.percentile(acc, q)), 'Precision': tuple(np.percentile(all_p, q)),
+            'Recall': tuple(np.percentile(all_r, q)), 'F1': tuple(np.percentile(all_f, q))}
+
+def eval_scores(cm, direction_type, print_scores=True, save_fp=None, n_bootstrap=1000):
+    each_p, each_r, each_f, all_p, all_r, all_f, acc = confusion_scores(cm)
+    final_acc = float(acc) * 100
+    intervals = bootstrap_scores(cm, n_bootstrap) if n_bootstrap > 0 else None
 
     dt = pm.inv_tech_dict[direction_type]
     score_list = ["Precision", "Recall", "F1"]
@@ -214,11 +296,23 @@ def eval_scores(cm, direction_type, print_scores=True, save_fp=None):
         scores.append([dt[idx], "{:.4f}".format(_p), "{:.4f}".format(_r), "{:.4f}".format(_f)])
     if print_scores: print row_format_2.format("All", all_p, all_r, all_f)
     scores.append(["All", "{:.4f}".format(all_p), "{:.4f}".format(all_r), "{:.4f}".format(all_f)])
+    ci_rows = []
+    if intervals is not None:
+        ### Bootstrap confidence intervals, kept out of the returned scores
+        ci_rows = [['---'], ['95% CI', 'Low', 'High']]
+        for name in ['Accuracy'] + score_list:
+            low, high = intervals[name]
+            ci_rows.append([name, "{:.4f}".format(low), "{:.4f}".format(high)])
+        if print_scores:
+            print('')
+            print('95% confidence intervals ({} bootstrap samples):'.format(n_bootstrap))
+            for r in ci_rows[2:]:
+                print("{:>10}  [{}, {}]".format(*r))
     if save_fp is not None:
         ### Save as a csv file
         cm_table = np.hstack(([[dt[i]] for i in range(pm.NUM_CLASS)], cm))
         cm_table = np.vstack(([[''] + [dt[i] for i in range(pm.NUM_CLASS)]], cm_table))
-        data = cm_table.tolist() + [['Accuracy', '{:.2f} %'.format(final_acc)], ['---']] + scores
+        data = cm_table.tolist() + [['Accuracy', '{:.2f} %'.format(final_acc)], ['---']] + scores + ci_rows
         
         csv_fi = open(save_fp, 'w')
         w = csv.writer(csv_fi, delimiter = ',')
@@ -229,7 +323,31 @@ def eval_scores(cm, direction_type, print_scores=True, save_fp=None):
 
 #=====MAIN FUNCTION=====#
 
-def main(model_name, model_type, model_opts, data_dir, sep_direction=True, test_aug=False, description=None):
+def load_feature_bank(audio_dir, mc_dir, model_class, sep_direction=True, store_dir=None, n_jobs=1, 
+                      n_aug=0, aug_seed=0):
+    """
+    Load the feature bank from the feature store in store_dir, extracting
+    the features (with n_aug augmented copies of every clip) and saving them 
+    there first if the store is missing or stale.
+    """
+    if store_dir is None:
+        store_dir = os.path.join(os.path.dirname(os.path.normpath(audio_dir)), 'features', 
+                                 feature_class_name(model_class))
+    store = FeatureStore(store_dir)
+    augment = {'n_aug': n_aug, 'seed': aug_seed, 'opts': pm.aug_opts} if n_aug > 0 else None
+    if store.is_stale(model_class, audio_dir, mc_dir, sep_direction, augment):
+        ### Fail before the (long) feature extraction rather than after it
+        store.check_writable()
+        feature_bank = load_n_preprocess_input_feature(audio_dir, mc_dir, model_class, sep_direction, n_jobs, 
+                                                       n_aug, aug_seed)
+        store.save(feature_bank, model_class, audio_dir, mc_dir, sep_direction, augment)
+    start_time = time.time()
+    feature_bank = store.load()
+    print('Loaded features from {} in {:.3f} secs.'.format(store_dir, time.time()-start_time))
+    return feature_bank
+
+def main(model_name, model_type, model_opts, data_dir, sep_direction=True, test_aug=False, description=None, 
+         n_jobs=1, store_dir=None, n_aug=0, aug_seed=0, balance=None):
     if description is not None:
         print('Description: {}'.format(description))
     audio_dir = os.path.join(data_dir, 'audio')
@@ -237,10 +355,10 @@ def main(model_name, model_type, model_opts, data_dir, sep_direction=True, test_
     model_class = getattr(models, model_type)
     param_set = getattr(pm, model_opts)
     ### load and pre-process input features
-    # feature_bank = load_n_preprocess_input_feature(audio_dir, mc_dir, model_class, sep_direction)
-    # np.save('feature_bank_mfcc.npy', feature_bank)
-    feature_bank = np.load('feature_bank_mfcc.npy').item()
-    all_results = classify(feature_bank, model_name, model_class, param_set, sep_direction=True, test_aug=False)
+    feature_bank = load_feature_bank(audio_dir, mc_dir, model_class, sep_direction, store_dir, n_jobs, 
+                                     n_aug, aug_seed)
+    all_results = classify(feature_bank, model_name, model_class, param_set, sep_direction=True, test_aug=False, 
+                           balance=balance)
     return all_results
 
 
@@ -265,9 +383,22 @@ Script for training guitar playing technique classification models.
                     help='The directory of the dataset to be used.')
     p.add_argument('-d', '--description', type=str, 
                     help='The description of this model.')
+    p.add_argument('-j', '--jobs', type=int, default=1,
+                    help='The number of worker processes loading the dataset.')
+    p.add_argument('-s', '--store_dir', type=str, default=None,
+                    help='The feature store directory, built again whenever the dataset or the feature ' \
+                         'parameters change. Defaults to <data_dir>/features/<feature class>.')
+    p.add_argument('-a', '--augment', type=int, default=0,
+                    help='The number of augmented copies of every clip added to the feature store.')
+    p.add_argument('--aug_seed', type=int, default=0,
+                    help='The seed of the augmentations.')
+    p.add_argument('-b', '--balance', type=str, default=None, choices=['balanced', 'weighted'],
+                    help='Train every epoch on a new class-balanced sample of the training set.')
     return p.parse_args()
 
 if __name__ == '__main__':
     args = parser()
-    main(args.model_name, args.model_type, args.model_opts, args.data_dir, description=args.description)
+    main(args.model_name, args.model_type, args.model_opts, args.data_dir, description=args.description, 
+         n_jobs=args.jobs, store_dir=args.store_dir, n_aug=args.augment, aug_seed=args.aug_seed, 
+         balance=args.balance)
 
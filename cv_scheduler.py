@@ -0,0 +1,210 @@
+"""
+--------------------------------------------------------------------------------
+Script for training the cross-validation folds of classification models in
+parallel.
+--------------------------------------------------------------------------------
+classification.py trains every fold of every direction one after another, and
+multi_iter_classification.py repeats that for several iterations. Here every
+(iteration, direction, fold) is a job run by a worker process, with at most
+n_jobs workers at a time. Each worker slot compiles into its own Theano
+compile directory, so concurrent workers do not wait for each other's
+compile lock. Jobs load the feature bank from the feature store, which is
+built once before the jobs start.
+
+Confusion matrices are added up as jobs complete. The evaluation csv files
+are written as with classification.py: one per iteration model, and the
+total of all iterations when there is more than one. Results missing a
+failed fold are incomplete: their csv files are not written, and the script
+exits with status 1.
+
+Example:
+    $ python cv_scheduler.py mfcc_cnn MFCCCNNModel cnn_opts data -i 5 -j 4
+--------------------------------------------------------------------------------
+"""
+import os, sys, subprocess, time
+import numpy as np
+from guitar_trans import parameters as pm
+
+def job_name(model_name, iteration, n_iteration):
+    ### Same model names as multi_iter_classification.py
+    return model_name if n_iteration == 1 else model_name + '_' + str(iteration)
+
+def worker_env(compile_root, slot):
+    env = dict(os.environ)
+    flags = env.get('THEANO_FLAGS', '')
+    compiledir = os.path.abspath(os.path.join(compile_root, 'worker_{}'.format(slot)))
+    env['THEANO_FLAGS'] = (flags + ',' if flags else '') + 'base_compiledir=' + compiledir
+    return env
+
+def run_job(args):
+    ### Runs in the worker process: train one fold and save its confusion matrix
+    import classification as clf
+    from guitar_trans import models
+    from guitar_trans.feature_store import FeatureStore
+    clf.model_dir, clf.output_dir = args.model_dir, args.output_dir
+    model_class = getattr(models, args.model_type)
+    param_set = getattr(pm, args.model_opts)
+    bank = FeatureStore(args.store_dir).load()[args.direction]
+    direction_type = args.direction if args.sep_direction else pm.D_MIXED
+    cm = clf.train_fold(bank, args.fold, args.job_name, model_class, param_set, direction_type,
+                        balance=args.balance)
+    np.save(args.cm_fp, cm)
+
+def main(model_name, model_type, model_opts, data_dir, iteration=1, n_jobs=2, sep_direction=True,
+         store_dir=None, description=None, load_jobs=1, n_aug=0, aug_seed=0, balance=None):
+    import classification as clf
+    from guitar_trans import models
+    from guitar_trans.feature_store import feature_class_name
+    if n_jobs < 1:
+        raise ValueError('n_jobs must be at least 1, not {}.'.format(n_jobs))
+    if description is not None:
+        print('Description: {}'.format(description))
+    audio_dir = os.path.join(data_dir, 'audio')
+    mc_dir = os.path.join(data_dir, 'melody')
+    model_class = getattr(models, model_type)
+    if store_dir is None:
+        store_dir = os.path.join(data_dir, 'features', feature_class_name(model_class))
+    ### Build the feature store once; every job memory-maps it
+    feature_bank = clf.load_feature_bank(audio_dir, mc_dir, model_class, sep_direction, store_dir, load_jobs,
+                                         n_aug, aug_seed)
+
+    names = [job_name(model_name, i, iteration) for i in range(iteration)]
+    for name in names:
+        clf.prepare_dirs(name)
+    work_dir = os.path.join(clf.output_dir, model_name, 'cv_jobs')
+    for d in ('logs', 'cms', 'theano'):
+        if not os.path.isdir(os.path.join(work_dir, d)):
+            os.makedirs(os.path.join(work_dir, d))
+    jobs = [(name, direction, idx) for name in names
+            for direction in sorted(feature_bank) for idx in range(len(feature_bank[direction]))]
+
+    results = dict(((name, d), np.zeros((pm.NUM_CLASS, pm.NUM_CLASS), dtype=int))
+                   for name in names for d in feature_bank)
+    failed = []
+    running = {}
+    free_slots = range(n_jobs)
+    n_total, n_finished = len(jobs), 0
+    start_time = time.time()
+    print('Running {} jobs with {} workers...'.format(n_total, n_jobs))
+    while jobs or running:
+        while jobs and free_slots:
+            name, direction, idx = job = jobs.pop(0)
+            slot = free_slots.pop(0)
+            job_id = '{}.{}.{}'.format(name, direction, idx)
+            cm_fp = os.path.join(work_dir, 'cms', job_id + '.npy')
+            cmd = [sys.executable, os.path.abspath(__file__), 'worker', model_type, model_opts, store_dir,
+                   '--job_name', name, '--direction', direction, '--fold', str(idx), '--cm_fp', cm_fp,
+                   '--model_dir', clf.model_dir, '--output_dir', clf.output_dir]
+            if not sep_direction: cmd.append('--mixed')
+            if balance: cmd += ['--balance', balance]
+            log = open(os.path.join(work_dir, 'logs', job_id + '.log'), 'w')
+            proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT,
+                                    env=worker_env(os.path.join(work_dir, 'theano'), slot))
+            running[proc] = (job, slot, log, cm_fp, time.time())
+        time.sleep(1.0)
+        for proc in [p for p in running if p.poll() is not None]:
+            (name, direction, idx), slot, log, cm_fp, job_start = running.pop(proc)
+            log.close()
+            free_slots.append(slot)
+            if proc.returncode == 0 and os.path.isfile(cm_fp):
+                results[(name, direction)] += np.load(cm_fp)
+                status = 'done'
+            else:
+                failed.append((name, direction, idx))
+                status = 'FAILED (see {})'.format(log.name)
+            n_finished += 1
+            print('[{}/{}] {} {} fold {}: {} in {:.0f} s'.format(
+                n_finished, n_total, name, direction, idx, status, time.time() - job_start))
+            sys.stdout.flush()
+
+    ### Only complete cross-validations are evaluated
+    incomplete = set((name, direction) for name, direction, idx in failed)
+    all_results = {}
+    for d in sorted(feature_bank):
+        direction_type = d if sep_direction else pm.D_MIXED
+        csv_fn = 'evaluation.' + direction_type + '.csv'
+        for name in names:
+            if (name, d) in incomplete:
+                print('Result of {} {} is INCOMPLETE (failed folds), not written.'.format(name, d))
+                continue
+            print('Result of {} {}'.format(name, d))
+            clf.eval_scores(results[(name, d)], d, print_scores=True,
+                            save_fp=os.path.join(clf.output_dir, name, csv_fn))
+        if any((name, d) in incomplete for name in names):
+            continue
+        all_results[d] = sum(results[(name, d)] for name in names)
+        if iteration > 1:
+            print('Final result of {}'.format(d))
+            clf.eval_scores(all_results[d], d, print_scores=True,
+                            save_fp=os.path.join(clf.output_dir, model_name, csv_fn))
+    if failed:
+        print('{} jobs failed: {}'.format(len(failed), failed))
+    print('All jobs finished in {:.0f} s.'.format(time.time() - start_time))
+    return all_results, failed
+
+def parser():
+    import argparse
+    p = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=
+    """
+===================================================================
+Script for training cross-validation folds in parallel.
+===================================================================
+    """)
+    p.add_argument('model_name', type=str, metavar='model_name',
+                    help='The name of this new model.')
+    p.add_argument('model_type', type=str, metavar='model_type',
+                    help='The type of this new model. The types are the classes defined in models.py.')
+    p.add_argument('model_opts', type=str, metavar='model_opts',
+                    help='The name of parameter dictionary of this new model, defined in parameters.py.')
+    p.add_argument('data_dir', type=str, metavar='data_dir',
+                    help='The directory of the dataset to be used.')
+    p.add_argument('-d', '--description', type=str,
+                    help='The description of this model.')
+    p.add_argument('-i', '--iteration', type=int, default=1,
+                    help='The number of times every fold is trained.')
+    p.add_argument('-j', '--jobs', type=int, default=2,
+                    help='The maximum number of folds trained at the same time.')
+    p.add_argument('-s', '--store_dir', type=str, default=None,
+                    help='The feature store directory. Defaults to <data_dir>/features/<feature class>.')
+    p.add_argument('-l', '--load_jobs', type=int, default=1,
+                    help='The number of worker processes building the feature store.')
+    p.add_argument('-a', '--augment', type=int, default=0,
+                    help='The number of augmented copies of every clip added to the feature store.')
+    p.add_argument('--aug_seed', type=int, default=0,
+                    help='The seed of the augmentations.')
+    p.add_argument('-b', '--balance', type=str, default=None, choices=['balanced', 'weighted'],
+                    help='Train every epoch on a new class-balanced sample of the training set.')
+    args = p.parse_args()
+    if args.jobs < 1:
+        p.error('--jobs must be at least 1.')
+    return args
+
+def worker_parser():
+    import argparse
+    p = argparse.ArgumentParser(description='Train one fold (used by cv_scheduler.py).')
+    p.add_argument('command', choices=['worker'])
+    p.add_argument('model_type', type=str)
+    p.add_argument('model_opts', type=str)
+    p.add_argument('store_dir', type=str)
+    p.add_argument('--job_name', type=str, required=True)
+    p.add_argument('--direction', type=str, required=True)
+    p.add_argument('--fold', type=int, required=True)
+    p.add_argument('--cm_fp', type=str, required=True)
+    p.add_argument('--model_dir', type=str, required=True)
+    p.add_argument('--output_dir', type=str, required=True)
+    p.add_argument('--mixed', dest='sep_direction', action='store_false')
+    p.add_argument('--balance', type=str, default=None)
+    return p.parse_args()
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        run_job(worker_parser())
+    else:
+        args = parser()
+        all_results, failed = main(args.model_name, args.model_type, args.model_opts, args.data_dir, 
+                                   args.iteration, args.jobs, store_dir=args.store_dir, 
+                                   description=args.description, load_jobs=args.load_jobs,
+                                   n_aug=args.augment, aug_seed=args.aug_seed, balance=args.balance)
+        sys.exit(1 if failed else 0)
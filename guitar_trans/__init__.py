@@ -1,10 +1,14 @@
 from . import contour
-from . import evaluation
-from . import models
+from . import feature_store
 from . import note
 from . import parameters
+from . import profiling
 from . import song
 from . import te_note_tracking
 from . import technique
 
+### models (Theano, Lasagne) and evaluation (mir_eval) are slow to import and
+### are not needed by every script: import them explicitly, e.g.
+### from guitar_trans import models
+
 # __version__ = '0.2.0'
\ No newline at end of file
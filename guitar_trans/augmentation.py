@@ -0,0 +1,84 @@
+"""
+Data augmentation of training clips and their melody contours.
+--------------------------------------------------------------------------------
+Every augmented copy of a clip applies, with parameters drawn at random within
+the ranges of parameters.aug_opts,
+
+    pitch shift:    the audio is shifted by up to +-'pitch_shift' semitones
+                    and the voiced part of the contour by the same amount
+    gain:           up to +-'gain_db' dB
+    time offset:    audio and contour move by up to +-'time_offset' frames
+    noise:          white noise at a SNR within 'noise_snr_db'
+
+The random generator of each copy is seeded from the seed, the clip's file
+name and the copy number, so the same clips are generated in any process and
+in any order. Augmented copies are named <fn>_aug<k>, which classification
+recognizes as augmented ('aug' in fn).
+--------------------------------------------------------------------------------
+"""
+import zlib
+import numpy as np
+import librosa as rosa
+from parameters import SAMPLING_RATE, HOP_LENGTH, aug_opts as default_aug_opts
+
+def clip_rng(seed, fn, k):
+    return np.random.RandomState(zlib.crc32('{}:{}:{}'.format(seed, fn, k)) & 0xffffffff)
+
+def pitch_shift(y, mc, n_steps, sr=SAMPLING_RATE):
+    y = rosa.effects.pitch_shift(y, sr, n_steps=n_steps)
+    mc = np.where(mc > 0, mc + n_steps, mc).astype(mc.dtype)
+    return y, mc
+
+def gain(y, mc, db):
+    return y * np.float32(10 ** (db / 20.0)), mc
+
+def time_offset(y, mc, n_frames, hop_length=HOP_LENGTH):
+    ### Positive n_frames delays the clip; the audio is padded with silence
+    ### and the contour with its edge values
+    if n_frames == 0:
+        return y, mc
+    n_samples = n_frames * hop_length
+    if n_frames > 0:
+        y = np.concatenate((np.zeros(n_samples, dtype=y.dtype), y[:-n_samples]))
+        mc = np.concatenate((np.repeat(mc[:1], n_frames), mc[:-n_frames]))
+    else:
+        y = np.concatenate((y[-n_samples:], np.zeros(-n_samples, dtype=y.dtype)))
+        mc = np.concatenate((mc[-n_frames:], np.repeat(mc[-1:], -n_frames)))
+    return y, mc
+
+def add_noise(y, mc, snr_db, rng):
+    rms = np.sqrt(np.mean(y ** 2))
+    noise = rng.normal(0.0, rms / 10 ** (snr_db / 20.0), size=len(y))
+    return (y + noise).astype(y.dtype), mc
+
+def augment_clip(y, mc, fn, n_aug, seed=0, opts=None):
+    """
+    Parameters
+    ----------
+    y: np.ndarray, the audio clip
+    mc: np.ndarray, its preprocessed melody contour
+    fn: str, the file name of the clip
+    n_aug: int, the number of augmented copies
+    opts: dict, the ranges of the augmentations (default: parameters.aug_opts)
+
+    Returns
+    -------
+    aug_list: list of (y, mc, fn) of the augmented copies
+    """
+    opts = default_aug_opts if opts is None else opts
+    aug_list = []
+    for k in range(n_aug):
+        rng = clip_rng(seed, fn, k)
+        ### Draw every parameter, even of disabled augmentations, so that each one
+        ### keeps its values when another one is switched off
+        n_steps = rng.uniform(-1.0, 1.0) * opts['pitch_shift']
+        db = rng.uniform(-1.0, 1.0) * opts['gain_db']
+        n_frames = rng.randint(-opts['time_offset'], opts['time_offset'] + 1)
+        snr_db = rng.uniform(*opts['noise_snr_db']) if opts['noise_snr_db'] else None
+        y_aug, mc_aug = y, mc
+        if opts['pitch_shift']: y_aug, mc_aug = pitch_shift(y_aug, mc_aug, n_steps)
+        if opts['gain_db']: y_aug, mc_aug = gain(y_aug, mc_aug, db)
+        y_aug, mc_aug = time_offset(y_aug, mc_aug, n_frames)
+        if snr_db is not None: y_aug, mc_aug = add_noise(y_aug, mc_aug, snr_db, rng)
+        aug_list.append((y_aug, mc_aug, '{}_aug{}'.format(fn, k)))
+    return aug_list
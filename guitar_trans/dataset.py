@@ -0,0 +1,207 @@
+"""
+Minibatch access to feature banks that do not fit in memory.
+--------------------------------------------------------------------------------
+A Dataset is a list of parts, each with the columns of a feature bank fold
+(see feature_store.FoldView): a list of input arrays, the answers and the
+file names. The arrays are usually memory-mapped from a FeatureStore, and a
+Dataset only holds indices into them, so subsets, splits and shuffles never
+copy features.
+
+batches() assembles each minibatch into contiguous arrays on a background
+thread while the previous one is being trained on:
+
+    for ra, mc, ans, fns in dataset.batches(10, shuffle=True):
+        err, pred = train_fn(ra, mc, ans)
+
+BalancedSampler draws a new class-balanced subset of a Dataset every epoch,
+again as indices only.
+--------------------------------------------------------------------------------
+"""
+import threading, Queue
+import numpy as np
+from feature_store import FoldView, stack_rows
+
+class Dataset(object):
+    def __init__(self, parts, index=None):
+        """
+        Parameters
+        ----------
+        parts: list of FoldView (or objects with inputs, ans and fns)
+        index: np.ndarray, shape=(n, 2), the (part, row) of every element;
+            all rows of all parts if None
+        """
+        self.parts = parts
+        if index is None:
+            index = np.array([(p, i) for p, part in enumerate(parts) for i in range(len(part))],
+                             dtype=int).reshape((-1, 2))
+        self.index = index
+
+    @staticmethod
+    def from_list(feature_list):
+        ### Stack a list of (input_1, ..., input_k, ans, fn) tuples into one in-memory part
+        if len(feature_list) == 0:
+            return Dataset([])
+        n_input = len(feature_list[0]) - 2
+        inputs = [stack_rows([feat[j] for feat in feature_list], 'float32', 'input {}'.format(j)) 
+                  for j in range(n_input)]
+        ans = np.array([feat[-2] for feat in feature_list], dtype='int32')
+        fns = np.array([feat[-1] for feat in feature_list])
+        return Dataset([FoldView(inputs, ans, fns)])
+
+    @staticmethod
+    def from_folds(folds):
+        ### One part per fold; folds loaded from a FeatureStore are used as they are
+        parts = []
+        for fold in folds:
+            if isinstance(fold, FoldView):
+                parts.append(fold)
+            elif len(fold) > 0:
+                parts += Dataset.from_list(fold).parts
+        return Dataset(parts)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        p, row = self.index[i]
+        return self.parts[p][row]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def subset(self, idx):
+        return Dataset(self.parts, self.index[np.asarray(idx, dtype=int)])
+
+    def concat(self, other):
+        ### Elements of self followed by those of other, without copying features
+        offset = len(self.parts)
+        other_index = other.index + np.array([offset, 0])
+        return Dataset(self.parts + other.parts, np.concatenate((self.index, other_index)))
+
+    def fns(self):
+        return np.array([self.parts[p].fns[row] for p, row in self.index])
+
+    def labels(self):
+        ### The class number of every element, read from the (small) answer arrays only
+        labels = np.zeros(len(self), dtype=int)
+        for p, part in enumerate(self.parts):
+            mask = self.index[:, 0] == p
+            if mask.any():
+                labels[mask] = np.argmax(np.asarray(part.ans)[self.index[mask, 1]], axis=1)
+        return labels
+
+    def get_batch(self, idx):
+        """
+        Gather the elements idx into contiguous arrays.
+
+        Returns
+        -------
+        (input_1, ..., input_k, ans, fns), every one with len(idx) rows
+        """
+        index = self.index[idx]
+        first = self.parts[index[0, 0]]
+        n_input = len(first.inputs)
+        cols = [np.empty((len(idx),) + first.inputs[j].shape[1:], dtype='float32') for j in range(n_input)]
+        cols.append(np.empty((len(idx),) + first.ans.shape[1:], dtype='int32'))
+        fns = [None] * len(idx)
+        for p in np.unique(index[:, 0]):
+            part = self.parts[p]
+            pos = np.where(index[:, 0] == p)[0]
+            ### Read the rows of a part in file order, which is much faster on memory-mapped arrays
+            order = np.argsort(index[pos, 1])
+            pos, rows = pos[order], index[pos[order], 1]
+            for j in range(n_input):
+                cols[j][pos] = part.inputs[j][rows]
+            cols[-1][pos] = part.ans[rows]
+            for k, row in zip(pos, rows):
+                fns[k] = part.fns[row]
+        return tuple(cols) + (fns,)
+
+    def batches(self, batch_size, shuffle=False, prefetch=2):
+        """
+        Yield (input_1, ..., input_k, ans, fns) minibatches of batch_size
+        elements (the last one may be smaller), in a new random order if
+        shuffle. Up to prefetch batches are assembled ahead on another thread.
+        """
+        order = np.random.permutation(len(self)) if shuffle else np.arange(len(self))
+        starts = range(0, len(self), batch_size)
+        if prefetch <= 0:
+            for s in starts:
+                yield self.get_batch(order[s:s + batch_size])
+            return
+        queue = Queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+        ### Bound here, since module globals may already be None at interpreter shutdown
+        full = Queue.Full
+        def put(item):
+            ### Give up if the consumer has stopped, instead of blocking on a full queue
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except full:
+                    pass
+            return False
+        def produce():
+            try:
+                for s in starts:
+                    if not put((self.get_batch(order[s:s + batch_size]), None)):
+                        return
+            except Exception as e:
+                put((None, e))
+        producer = threading.Thread(target=produce)
+        producer.daemon = True
+        producer.start()
+        try:
+            for _ in starts:
+                batch, error = queue.get()
+                if error is not None:
+                    raise error
+                yield batch
+        finally:
+            ### Let the producer exit if the consumer stops early, and wait for it
+            stop.set()
+            producer.join()
+
+def as_dataset(feature_list):
+    return feature_list if isinstance(feature_list, Dataset) else Dataset.from_list(feature_list)
+
+class BalancedSampler(object):
+    """
+    Draws a new subset of a Dataset every epoch from per-class index arrays,
+    without copying any features.
+
+    mode 'balanced': every class gets n_per_class elements (default: the size
+        of the smallest class), drawn without replacement.
+    mode 'weighted': len(dataset) elements drawn with replacement, each class
+        with a total probability proportional to class_weights (default: equal).
+    """
+    def __init__(self, dataset, mode='balanced', n_per_class=None, class_weights=None):
+        assert mode in ('balanced', 'weighted'), "Unknown sampling mode {}.".format(mode)
+        self.dataset = dataset
+        self.mode = mode
+        labels = dataset.labels()
+        n_class = labels.max() + 1 if len(labels) > 0 else 0
+        self.class_idx = [np.where(labels == c)[0] for c in range(n_class)]
+        self.n_per_class = n_per_class
+        if class_weights is None:
+            class_weights = [1.0 if len(idx) > 0 else 0.0 for idx in self.class_idx]
+        ### Probability of every element: its class weight split among the class
+        prob = np.zeros(len(dataset))
+        for w, idx in zip(class_weights, self.class_idx):
+            if len(idx) > 0: prob[idx] = float(w) / len(idx)
+        self.prob = prob / prob.sum() if prob.sum() > 0 else prob
+
+    def epoch_indices(self):
+        if self.mode == 'weighted':
+            return np.random.choice(len(self.dataset), size=len(self.dataset), p=self.prob)
+        n = self.n_per_class
+        if n is None:
+            n = min(len(idx) for idx in self.class_idx if len(idx) > 0)
+        idx = np.concatenate([np.random.choice(c_idx, min(n, len(c_idx)), replace=False)
+                              for c_idx in self.class_idx if len(c_idx) > 0])
+        return np.random.permutation(idx)
+
+    def epoch(self):
+        return self.dataset.subset(self.epoch_indices())
@@ -183,9 +183,9 @@ def calculate_esn_f_measure(ans_list, pred_list, tech, onset_tolerance=0.1, offs
         if pred.onset > ans.onset + onset_tolerance: return False, a_i + 1, p_i
         # Check tech correctness
         if tech in [T_PULL, T_HAMMER, T_SLIDE]:
-            tech_cond = ans.tech(tech).value in [1,3] and pred.tech(tech).value in [1,3]
+            tech_cond = ans.tech_value(tech) in [1,3] and pred.tech_value(tech) in [1,3]
         else:
-            tech_cond = ans.equal_tech(pred) if tech is None else (ans.tech(tech).value > 0 and pred.tech(tech).value > 0)
+            tech_cond = ans.equal_tech(pred) if tech is None else (ans.tech_value(tech) > 0 and pred.tech_value(tech) > 0)
         if not tech_cond:
             (a_i, p_i) = (a_i, p_i + 1) if pred.onset < ans.onset else (a_i + 1, p_i)
             return False, a_i, p_i
@@ -203,9 +203,9 @@ def calculate_esn_f_measure(ans_list, pred_list, tech, onset_tolerance=0.1, offs
         while idx < len(esn_list):
             esn = esn_list[idx]
             if tch in [T_PULL, T_HAMMER, T_SLIDE]:
-                if esn.tech(tch).value in [1, 3]:
+                if esn.tech_value(tch) in [1, 3]:
                     ct += 1
-            elif esn.tech(tch).value > 0:
+            elif esn.tech_value(tch) > 0:
                 ct += 1
             idx += 1
         return ct
@@ -219,7 +219,7 @@ def calculate_esn_f_measure(ans_list, pred_list, tech, onset_tolerance=0.1, offs
         #     correct, a_i, p_i = check_condition(a_i + 1, p_i + 1)
         if correct: 
             TP += 1
-    tch_list = range(T_PREBEND, T_NORMAL) if tech is None else [tech]
+    tch_list = TECH_COLUMNS if tech is None else [tech]
     n_pred_techs, n_ans_techs = 0, 0
     for tch in tch_list:
         n_pred_techs += count_tech_in_list(pred_list, tch)
@@ -0,0 +1,222 @@
+"""
+On-disk store of a cross-validation feature bank.
+--------------------------------------------------------------------------------
+A feature bank maps every direction to a list of folds (one per pm.cv_list
+entry), each a list of feature tuples (input_1, ..., input_k, ans, fn) as
+returned by Feature.extract_features. The store keeps each fold as separate
+contiguous arrays,
+
+    <store_dir>/manifest.json
+    <store_dir>/<direction>/fold_<i>.in<j>.npy     float32, (n, ...)
+    <store_dir>/<direction>/fold_<i>.ans.npy       int32, (n, NUM_CLASS)
+    <store_dir>/<direction>/fold_<i>.fn.npy        str, (n,)
+
+which are memory-mapped when loaded, so loading is instant and a fold only
+takes memory when its clips are read. The manifest records the feature class,
+the parameters the features depend on (including the augmentation settings,
+if the bank has augmented clips) and a fingerprint of the contents of the
+source files; the store is stale, and must be built again, when any of them
+changes. FeatureStore(store_dir, quick=True) fingerprints file sizes and
+modification times instead, which is cheaper but misses e.g. files restored
+with their original times.
+
+A store only ever deletes the manifest and the <direction> folders it wrote
+itself, and refuses to write into a non-empty directory without a manifest.
+A new store is written to a temporary sibling directory and then moved in.
+
+    store = FeatureStore('features/MFCCFeature')
+    if store.is_stale(MFCCCNNModel, audio_dir, mc_dir, sep_direction):
+        store.save(load_n_preprocess_input_feature(...), MFCCCNNModel,
+                   audio_dir, mc_dir, sep_direction)
+    feature_bank = store.load()
+--------------------------------------------------------------------------------
+"""
+import hashlib, json, os, shutil, tempfile
+import numpy as np
+import parameters as pm
+
+STORE_VERSION = 1
+
+def feature_class_name(m_class):
+    ### The Feature subclass a model class extracts its features with
+    from models import Feature
+    for c in m_class.__mro__:
+        if issubclass(c, Feature) and c is not Feature:
+            return c.__name__
+    return m_class.__name__
+
+def feature_params(m_class, sep_direction, augment=None):
+    return {'feature_class': feature_class_name(m_class),
+            'clip_length': m_class.clip_length,
+            'sep_direction': bool(sep_direction),
+            'augment': augment,
+            'sampling_rate': pm.SAMPLING_RATE,
+            'hop_length': pm.HOP_LENGTH,
+            'mc_length': pm.MC_LENGTH,
+            'num_class': pm.NUM_CLASS,
+            'cv_list': pm.cv_list}
+
+def source_fingerprint(dirs, quick=False):
+    """
+    Hash of the relative path and the contents of every file under dirs, or
+    with quick, of the relative path, size and modification time.
+    """
+    h = hashlib.sha1()
+    n_files = 0
+    for d in dirs:
+        for root, _, files in sorted(os.walk(d)):
+            for fi in sorted(files):
+                fp = os.path.join(root, fi)
+                h.update(os.path.relpath(fp, d) + '\0')
+                if quick:
+                    st = os.stat(fp)
+                    h.update('{}\t{}\n'.format(st.st_size, int(st.st_mtime)))
+                else:
+                    with open(fp, 'rb') as f:
+                        for chunk in iter(lambda: f.read(1 << 20), ''):
+                            h.update(chunk)
+                    h.update('\0')
+                n_files += 1
+    return {'sha1': h.hexdigest(), 'n_files': n_files, 'mode': 'stat' if quick else 'content'}
+
+def stack_rows(rows, dtype, name):
+    ### One array of the rows of a feature column, which must all have the same shape
+    shapes = sorted(set(np.shape(r) for r in rows))
+    if len(shapes) > 1:
+        raise ValueError('{} has rows of different shapes {}; features must have a fixed size '
+                         '(clips are padded or cropped to CLIP_LENGTH samples).'.format(name, shapes[:4]))
+    return np.array(rows, dtype=dtype)
+
+class FoldView(object):
+    """
+    A read-only, list-like view of one stored fold: indexing and iterating
+    give the same feature tuples the fold was saved from, backed by the
+    memory-mapped arrays.
+    """
+    def __init__(self, inputs, ans, fns):
+        self.inputs = inputs
+        self.ans = ans
+        self.fns = fns
+
+    def __len__(self):
+        return len(self.fns)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+        return tuple(inp[i] for inp in self.inputs) + (self.ans[i], self.fns[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class FeatureStore(object):
+    def __init__(self, store_dir, quick=False):
+        self.store_dir = store_dir
+        self.quick = quick
+        self.manifest_fp = os.path.join(store_dir, 'manifest.json')
+
+    def read_manifest(self):
+        if not os.path.isfile(self.manifest_fp):
+            return None
+        with open(self.manifest_fp) as f:
+            return json.load(f)
+
+    def is_stale(self, m_class, audio_dir, mc_dir, sep_direction, augment=None):
+        manifest = self.read_manifest()
+        if manifest is None:
+            return True
+        if manifest.get('version') != STORE_VERSION:
+            return True
+        ### Round-trip through json so that e.g. tuples compare equal to lists
+        params = json.loads(json.dumps(feature_params(m_class, sep_direction, augment)))
+        if manifest['params'] != params:
+            return True
+        return manifest['sources'] != source_fingerprint([audio_dir, mc_dir], self.quick)
+
+    def check_writable(self):
+        ### Raise IOError if store_dir holds anything but a feature store
+        if os.path.isdir(self.store_dir) and os.listdir(self.store_dir) and self.read_manifest() is None:
+            raise IOError('{} is not empty and is not a feature store; refusing to write '
+                          'features into it.'.format(self.store_dir))
+
+    def write_manifest(self, manifest):
+        with open(self.manifest_fp, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+
+    def save(self, feature_bank, m_class, audio_dir, mc_dir, sep_direction, augment=None):
+        self.check_writable()
+        print('Saving features to {}...'.format(self.store_dir))
+        parent_dir = os.path.dirname(os.path.abspath(self.store_dir))
+        if not os.path.isdir(parent_dir):
+            os.makedirs(parent_dir)
+        tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(os.path.abspath(self.store_dir)) + '.tmp', 
+                                   dir=parent_dir)
+        try:
+            folds = {}
+            for direction, bank in feature_bank.items():
+                d_dir = os.path.join(tmp_dir, direction)
+                os.makedirs(d_dir)
+                folds[direction] = []
+                for idx, fold in enumerate(bank):
+                    folds[direction].append(len(fold))
+                    if len(fold) == 0: continue
+                    prefix = os.path.join(d_dir, 'fold_{}'.format(idx))
+                    n_input = len(fold[0]) - 2
+                    for j in range(n_input):
+                        np.save('{}.in{}.npy'.format(prefix, j),
+                                stack_rows([feat[j] for feat in fold], 'float32',
+                                           '{} fold {} input {}'.format(direction, idx, j)))
+                    np.save(prefix + '.ans.npy', np.array([feat[-2] for feat in fold], dtype='int32'))
+                    np.save(prefix + '.fn.npy', np.array([feat[-1] for feat in fold]))
+
+            ### Swap the folds in. The old manifest is first replaced by a stale one that 
+            ### still lists its folders, and the new one is written last, so an 
+            ### interrupted save leaves a stale store that the next save can replace
+            if not os.path.isdir(self.store_dir):
+                os.makedirs(self.store_dir)
+            old = self.read_manifest()
+            if old is not None:
+                old_folds = dict(old.get('folds', {}))
+                old_folds.update((d, []) for d in folds)
+                self.write_manifest({'version': STORE_VERSION, 'params': None, 'sources': None, 
+                                     'folds': old_folds})
+                for direction in old_folds:
+                    d_dir = os.path.join(self.store_dir, direction)
+                    if os.path.isdir(d_dir):
+                        shutil.rmtree(d_dir)
+            for direction in folds:
+                os.rename(os.path.join(tmp_dir, direction), os.path.join(self.store_dir, direction))
+            self.write_manifest({'version': STORE_VERSION,
+                                 'params': feature_params(m_class, sep_direction, augment),
+                                 'sources': source_fingerprint([audio_dir, mc_dir], self.quick),
+                                 'folds': folds})
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def load(self, mmap_mode='r'):
+        """
+        Returns
+        -------
+        feature_bank: dict, direction -> list of FoldView, one per fold
+        """
+        manifest = self.read_manifest()
+        assert manifest is not None, "No feature store in {}.".format(self.store_dir)
+        feature_bank = {}
+        for direction, fold_lens in manifest['folds'].items():
+            direction = str(direction)
+            feature_bank[direction] = []
+            for idx, n in enumerate(fold_lens):
+                prefix = os.path.join(self.store_dir, direction, 'fold_{}'.format(idx))
+                if n == 0:
+                    feature_bank[direction].append(FoldView([], [], []))
+                    continue
+                inputs = []
+                j = 0
+                while os.path.isfile('{}.in{}.npy'.format(prefix, j)):
+                    inputs.append(np.load('{}.in{}.npy'.format(prefix, j), mmap_mode=mmap_mode))
+                    j += 1
+                ans = np.load(prefix + '.ans.npy', mmap_mode=mmap_mode)
+                fns = np.load(prefix + '.fn.npy')
+                feature_bank[direction].append(FoldView(inputs, ans, fns))
+        return feature_bank
@@ -1,4 +1,4 @@
-import os, sys, time, random
+import os, sys, time, random, threading, hashlib
 import numpy as np
 import librosa as rosa
 import theano
@@ -6,8 +6,11 @@ import theano.tensor as T
 import lasagne
 import pprint
 from lasagne import layers
-from sklearn.metrics import confusion_matrix
-from parameters import MC_LENGTH, SAMPLING_RATE, HOP_LENGTH
+from scipy.fftpack import dct
+from scipy.signal import get_window
+from parameters import MC_LENGTH, SAMPLING_RATE, HOP_LENGTH, CLIP_LENGTH, RUN_BATCH_SIZE, RUN_BATCH_BYTES, TRAIN_BATCH_SIZE
+from parameters import TRAIN_PATIENCE, CHECKPOINT_EVERY
+from dataset import Dataset, BalancedSampler, as_dataset
 
 #===== FUNCTIONS =====#
 
@@ -18,23 +21,136 @@ def log_softmax(x):
 def categorical_crossentropy_logdomain(log_predictions, targets):
     return -T.sum(targets * log_predictions, axis=1)
 
+### Mel filterbanks and windows shared by every batch, keyed by their parameters
+_mel_basis_cache = {}
+_window_cache = {}
+
+def _mel_basis(sr, n_fft, n_mels):
+    key = (sr, n_fft, n_mels)
+    if key not in _mel_basis_cache:
+        _mel_basis_cache[key] = rosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels)
+    return _mel_basis_cache[key]
+
+def _hann_window(n_fft):
+    if n_fft not in _window_cache:
+        _window_cache[n_fft] = get_window('hann', n_fft, fftbins=True)
+    return _window_cache[n_fft]
+
+def batch_melspectrogram(ys, sr=SAMPLING_RATE, n_fft=512, hop_length=HOP_LENGTH, n_mels=128):
+    """
+    Mel power spectrograms of equally long clips in one vectorized pass.
+    Equivalent to rosa.feature.melspectrogram on each clip (centered frames,
+    reflect padding, periodic Hann window, power 2).
+
+    Parameters
+    ----------
+    ys: np.ndarray, shape=(n_clip, n_sample)
+
+    Returns
+    -------
+    melspec: np.ndarray, shape=(n_clip, n_mels, n_frame)
+    """
+    ys = np.atleast_2d(ys)
+    pad = n_fft // 2
+    ys = np.pad(ys, ((0, 0), (pad, pad)), mode='reflect')
+    n_frame = 1 + (ys.shape[1] - n_fft) // hop_length
+    frame_idx = np.arange(n_fft)[np.newaxis, :] + hop_length * np.arange(n_frame)[:, np.newaxis]
+    frames = ys[:, frame_idx] * _hann_window(n_fft)
+    power = np.abs(np.fft.rfft(frames, axis=-1)) ** 2
+    melspec = np.dot(power, _mel_basis(sr, n_fft, n_mels).T)
+    return melspec.transpose(0, 2, 1)
+
+def batch_mfcc(ys=None, sr=SAMPLING_RATE, n_mfcc=13, n_fft=512, hop_length=HOP_LENGTH, melspec=None):
+    """
+    MFCCs of equally long clips in one vectorized pass, equivalent to
+    rosa.feature.mfcc on each clip. A precomputed batch_melspectrogram
+    (with the default 128 mel bands) can be given instead of ys.
+
+    Returns
+    -------
+    mfcc: np.ndarray, shape=(n_clip, n_mfcc, n_frame)
+    """
+    if melspec is None:
+        melspec = batch_melspectrogram(ys, sr, n_fft, hop_length)
+    log_spec = 10.0 * np.log10(np.maximum(1e-10, melspec))
+    ### Clip every clip at 80 dB below its own peak, as the per-clip log scaling does
+    log_spec = np.maximum(log_spec, log_spec.max(axis=(1, 2), keepdims=True) - 80.0)
+    return dct(log_spec, axis=1, type=2, norm='ortho')[:, :n_mfcc]
+
 #===== FUNCTIONS =====#
 
 class Feature(object):
+    ### Number of audio samples the features need every clip to have, None for any length
+    clip_length = None
+
     @staticmethod
     def extract_features(y, mc, fn, ans=None):
         # MUST BE OVERRIDDEN
         return None
 
+    @classmethod
+    def extract_features_batch(cls, ys, mcs, fns, anss=None):
+        ### Extract features of many clips. Override with a vectorized version if possible.
+        if anss is None:
+            return [cls.extract_features(y, mc, fn) for y, mc, fn in zip(ys, mcs, fns)]
+        return [cls.extract_features(y, mc, fn, ans) for y, mc, fn, ans in zip(ys, mcs, fns, anss)]
+
+    @classmethod
+    def song_feature_map(cls, y):
+        ### Frame-level audio features (the mel spectrogram) of a whole song at 
+        ### HOP_LENGTH, from which extract_features_from_map slices the clips.
+        ### None if the feature can only be computed per clip.
+        return None
+
+    @classmethod
+    def extract_features_from_map(cls, fmap, start_frames, mcs, fns, anss=None):
+        # MUST BE OVERRIDDEN by features defining song_feature_map
+        return None
+
+    @staticmethod
+    def slice_feature_map(fmap, start_frames, n_frame=MC_LENGTH):
+        ### Gather the (n_feature, n_frame) block of each clip from the song map
+        idx = np.asarray(start_frames, dtype=int)[:, np.newaxis] + np.arange(n_frame)
+        return fmap[:, idx].transpose(1, 0, 2)
+
     @staticmethod
     def melody_features(mc, norm=True):
         nmc = (mc - np.mean(mc)) / np.std(mc) if norm else mc # normalize melody contour
         dmc = np.gradient(nmc) # calculate the gradient (first derivative) of melody contour
         return nmc, dmc
 
+    @staticmethod
+    def batch_melody_features(mcs, norm=True):
+        mcs = np.atleast_2d(mcs)
+        nmc = (mcs - mcs.mean(axis=1, keepdims=True)) / mcs.std(axis=1, keepdims=True) if norm else mcs
+        dmc = np.gradient(nmc, axis=1)
+        return nmc, dmc
+
+    @staticmethod
+    def pack_batch(feats, fns, anss, nmc, dmc):
+        ### Split a batch of features into per-clip tuples, with None for clips 
+        ### whose melody features contain nan
+        nan_rows = np.isnan(nmc).any(axis=1) | np.isnan(dmc).any(axis=1)
+        data_list = []
+        for i, fn in enumerate(fns):
+            if nan_rows[i]:
+                print('nan in {}.'.format(fn))
+                data_list.append(None)
+            else:
+                data_list.append((feats[i], fn) if anss is None else (feats[i], anss[i], fn))
+        return data_list
+
 class RawFeature(Feature):
+    ### The raw audio is stacked into minibatches, so every clip is padded (with silence) 
+    ### or cropped to the length of the clips cut by transcription
+    clip_length = CLIP_LENGTH
+
     @staticmethod
     def extract_features(y, mc, fn, ans=None):
+        if len(y) < RawFeature.clip_length:
+            y = np.pad(y, (0, RawFeature.clip_length-len(y)), 'constant')
+        elif len(y) > RawFeature.clip_length:
+            y = y[:RawFeature.clip_length]
         nmc, dmc = Feature.melody_features(mc)
         if np.any(np.isnan([nmc, dmc])):
             print('nan in {}.'.format(fn))
@@ -60,6 +176,29 @@ class MFCCFeature(Feature):
         feat_all = np.concatenate((mfcc, mfcc_d, mfcc_d2, np.array([nmc]), np.array([dmc])), axis=0).astype('float32')
         return (feat_all, fn) if ans is None else (feat_all, ans, fn)
 
+    @classmethod
+    def extract_features_batch(cls, ys, mcs, fns, anss=None):
+        nmc, dmc = Feature.batch_melody_features(mcs)
+        mfcc = batch_mfcc(ys, n_mfcc=13)
+        mfcc_d = rosa.feature.delta(mfcc, axis=-1)
+        mfcc_d2 = rosa.feature.delta(mfcc, order=2, axis=-1)
+        feat_all = np.concatenate((mfcc, mfcc_d, mfcc_d2, nmc[:, np.newaxis], dmc[:, np.newaxis]), axis=1).astype('float32')
+        return Feature.pack_batch(feat_all, fns, anss, nmc, dmc)
+
+    @classmethod
+    def song_feature_map(cls, y):
+        return batch_melspectrogram(y, n_mels=128)[0]
+
+    @classmethod
+    def extract_features_from_map(cls, fmap, start_frames, mcs, fns, anss=None):
+        nmc, dmc = Feature.batch_melody_features(mcs)
+        ### Log scaling, DCT and deltas stay per clip, as in extract_features_batch
+        mfcc = batch_mfcc(n_mfcc=13, melspec=Feature.slice_feature_map(fmap, start_frames))
+        mfcc_d = rosa.feature.delta(mfcc, axis=-1)
+        mfcc_d2 = rosa.feature.delta(mfcc, order=2, axis=-1)
+        feat_all = np.concatenate((mfcc, mfcc_d, mfcc_d2, nmc[:, np.newaxis], dmc[:, np.newaxis]), axis=1).astype('float32')
+        return Feature.pack_batch(feat_all, fns, anss, nmc, dmc)
+
 class SpecFeature(Feature):
     @staticmethod
     def extract_features(y, mc, fn, ans=None):
@@ -72,6 +211,26 @@ class SpecFeature(Feature):
         feat_all = np.concatenate((melspec, np.array([mc]), np.array([dmc])), axis=0).astype('float32')
         return (feat_all, fn) if ans is None else (feat_all, ans, fn)
 
+    @classmethod
+    def extract_features_batch(cls, ys, mcs, fns, anss=None):
+        mcs = np.atleast_2d(mcs)
+        nmc, dmc = Feature.batch_melody_features(mcs)
+        melspec = batch_melspectrogram(ys, n_mels=128)
+        feat_all = np.concatenate((melspec, mcs[:, np.newaxis], dmc[:, np.newaxis]), axis=1).astype('float32')
+        return Feature.pack_batch(feat_all, fns, anss, nmc, dmc)
+
+    @classmethod
+    def song_feature_map(cls, y):
+        return batch_melspectrogram(y, n_mels=128)[0]
+
+    @classmethod
+    def extract_features_from_map(cls, fmap, start_frames, mcs, fns, anss=None):
+        mcs = np.atleast_2d(mcs)
+        nmc, dmc = Feature.batch_melody_features(mcs)
+        audio_feat = Feature.slice_feature_map(fmap, start_frames)
+        feat_all = np.concatenate((audio_feat, mcs[:, np.newaxis], dmc[:, np.newaxis]), axis=1).astype('float32')
+        return Feature.pack_batch(feat_all, fns, anss, nmc, dmc)
+
 class CocktailFeature(Feature):
     @staticmethod
     def extract_features(y, mc, fn, ans=None):
@@ -88,12 +247,45 @@ class CocktailFeature(Feature):
         feat_all = np.concatenate((mfcc, mfcc_d, mfcc_d2, melspec, np.array([nmc]), np.array([dmc])), axis=0).astype('float32')
         return (feat_all, fn) if ans is None else (feat_all, ans, fn)
 
+    @classmethod
+    def extract_features_batch(cls, ys, mcs, fns, anss=None):
+        nmc, dmc = Feature.batch_melody_features(mcs)
+        ### One mel spectrogram serves both the mel bands and the MFCCs
+        melspec = batch_melspectrogram(ys, n_mels=128)
+        mfcc = batch_mfcc(n_mfcc=13, melspec=melspec)
+        mfcc_d = rosa.feature.delta(mfcc, axis=-1)
+        mfcc_d2 = rosa.feature.delta(mfcc, order=2, axis=-1)
+        feat_all = np.concatenate((mfcc, mfcc_d, mfcc_d2, melspec, nmc[:, np.newaxis], dmc[:, np.newaxis]), axis=1).astype('float32')
+        return Feature.pack_batch(feat_all, fns, anss, nmc, dmc)
+
+    @classmethod
+    def song_feature_map(cls, y):
+        return batch_melspectrogram(y, n_mels=128)[0]
+
+    @classmethod
+    def extract_features_from_map(cls, fmap, start_frames, mcs, fns, anss=None):
+        nmc, dmc = Feature.batch_melody_features(mcs)
+        melspec = Feature.slice_feature_map(fmap, start_frames)
+        mfcc = batch_mfcc(n_mfcc=13, melspec=melspec)
+        mfcc_d = rosa.feature.delta(mfcc, axis=-1)
+        mfcc_d2 = rosa.feature.delta(mfcc, order=2, axis=-1)
+        feat_all = np.concatenate((mfcc, mfcc_d, mfcc_d2, melspec, nmc[:, np.newaxis], dmc[:, np.newaxis]), axis=1).astype('float32')
+        return Feature.pack_batch(feat_all, fns, anss, nmc, dmc)
+
 #===== MODELS =====#
 
 class Model(object):
-    def __init__(self, net_opts, fp):
+    def __init__(self, net_opts, fp, inference_only=False):
         self.net_opts = net_opts
         self.fp = fp
+        self.inference_only = inference_only
+        ### Minibatch size of training, validation and testing; a training setting, 
+        ### so it is not part of net_opts (which are saved with the model)
+        self.batch_size = TRAIN_BATCH_SIZE
+        ### Compiled functions are not reentrant; serialize run() across threads
+        self.run_lock = threading.Lock()
+        ### Optimizer state (not parameters) saved in training checkpoints, set by init_model
+        self.opt_vars = []
         self.init_model()
 
     #===== LAYERS =====#
@@ -116,9 +308,10 @@ class Model(object):
                                   ignore_border=False
                                  )
 
-    def iterate_minibatches(self, inputs, batchsize):
-        for start_idx in range(0, len(inputs), batchsize):
-            yield inputs[start_idx:start_idx + batchsize]
+    def iterate_minibatches(self, inputs, batchsize, shuffle=False):
+        ### Yield (input_1, ..., input_k, ans, fns) batches of contiguous arrays
+        for bt in as_dataset(inputs).batches(batchsize, shuffle):
+            yield bt
 
     def init_model(self):
         # MUST BE OVERRIDDEN
@@ -127,23 +320,66 @@ class Model(object):
         self.val_fn = None
         self.run_fn = None
 
+    def init_inference_model(self, input_vars):
+        ### Compile only the deterministic prediction graph of the built network:
+        ### no targets, losses or updates, and dropout is disabled.
+        prediction = layers.get_output(self.network, deterministic=True)
+        prediction = T.clip(prediction, 1e-7, 1.0 - 1e-7)
+        print('Building inference function...')
+        self.train_fn = None
+        self.val_fn = None
+        self.run_fn = theano.function(input_vars, [prediction], 
+                                      on_unused_input='ignore')
+
     def build_network(self):
         # MUST BE OVERRIDDEN
         self.network = None
         return self.network
 
-    def train(self, feature_list, num_epochs=60):
+    def train(self, feature_list, num_epochs=60, patience=None, checkpoint_every=None, resume=True, balance=None):
+        """
+        Train with 1/5 of feature_list held out for validation, keeping the
+        parameters of the epoch with the lowest validation loss in self.fp.
+
+        Parameters
+        ----------
+        patience: int, stop after this many epochs without a lower validation 
+            loss (default: TRAIN_PATIENCE, which is None: never stop early)
+        checkpoint_every: int, save a checkpoint every this many epochs 
+            (default: CHECKPOINT_EVERY, 0 to disable)
+        resume: bool, continue from the checkpoint of an interrupted run of the same 
+            model with the same net options
+        balance: str, 'balanced' or 'weighted' to train every epoch on a new 
+            class-balanced sample of the training set (see BalancedSampler)
+        """
         print('Start training...')
         sys.stdout.flush()
-        np.random.shuffle(feature_list)
-        ch = len(feature_list) / 5
-        val_list, train_list = feature_list[:ch], feature_list[ch:]
-        lowest_loss = 100.0
+        if patience is None:
+            patience = TRAIN_PATIENCE
+        if checkpoint_every is None:
+            checkpoint_every = CHECKPOINT_EVERY
+        dataset = as_dataset(feature_list)
         temp_model_file = '.temp_{}'.format(os.path.basename(self.fp))
         temp_model_fp = os.path.join(os.path.dirname(self.fp), temp_model_file)
-        for epoch in range(num_epochs):
+        ckpt_fp = os.path.join(os.path.dirname(self.fp), '.ckpt_{}'.format(os.path.basename(self.fp)))
+        ### perm indexes the clips in this order; a checkpoint of other clips or another order is not resumed
+        data_hash = hashlib.sha1('\n'.join(str(fn) for fn in dataset.fns())).hexdigest()
+        state = self.load_checkpoint(ckpt_fp, data_hash) if resume else None
+        if state is None:
+            state = {'epoch': 0, 'lowest_loss': 100.0, 'bad_epochs': 0, 
+                     'perm': np.random.permutation(len(dataset)), 'data_hash': data_hash}
+        else:
+            print('Resuming from epoch {} of {}.'.format(state['epoch'] + 1, ckpt_fp))
+        perm = state['perm']
+        ch = len(dataset) / 5
+        val_list, train_list = dataset.subset(perm[:ch]), dataset.subset(perm[ch:])
+        sampler = BalancedSampler(train_list, balance) if balance else None
+        lowest_loss = state['lowest_loss']
+        bad_epochs = state['bad_epochs']
+        for epoch in range(state['epoch'], num_epochs):
             start_time = time.time()
-            train_err, train_batches = self.train_one(train_list)
+            epoch_list = sampler.epoch() if sampler is not None else train_list
+            train_err, train_batches = self.train_one(epoch_list)
             val_err, val_acc, val_batches = self.val_one(val_list)
             
             # Print the results for this epoch:
@@ -158,23 +394,119 @@ class Model(object):
             # Save the lowest loss
             if val_loss < lowest_loss:
                 lowest_loss = val_loss
+                bad_epochs = 0
                 final_param = lasagne.layers.get_all_param_values(self.network)
                 self.save(temp_model_fp, final_param)
+            else:
+                bad_epochs += 1
+
+            stop = patience is not None and bad_epochs >= patience
+            ### No checkpoint when stopping early: there is nothing left to resume
+            if checkpoint_every and (epoch + 1) % checkpoint_every == 0 and not stop:
+                self.save_checkpoint(ckpt_fp, {'epoch': epoch + 1, 'lowest_loss': lowest_loss, 
+                                               'bad_epochs': bad_epochs, 'perm': perm, 
+                                               'data_hash': data_hash})
+            if stop:
+                print('No lower validation loss in {} epochs. Stop training.'.format(patience))
+                break
 
         os.rename(temp_model_fp, self.fp)
+        if os.path.isfile(ckpt_fp):
+            os.remove(ckpt_fp)
+
+    @staticmethod
+    def optimizer_vars(updates, params):
+        ### The shared variables of an update dictionary that are not parameters,
+        ### e.g. the accumulated gradients of adagrad
+        param_ids = set(id(p) for p in params)
+        return [v for v in updates if id(v) not in param_ids]
+
+    def save_checkpoint(self, ckpt_fp, state):
+        ### Write to a temporary file first so that an interruption never leaves a broken checkpoint
+        part_fp = ckpt_fp + '.part'
+        with open(part_fp, 'wb') as f:
+            np.savez(f, net_opts=self.net_opts, params=lasagne.layers.get_all_param_values(self.network),
+                        opt_state=[v.get_value() for v in self.opt_vars],
+                        epoch=state['epoch'], lowest_loss=state['lowest_loss'], 
+                        bad_epochs=state['bad_epochs'], perm=state['perm'], data_hash=state['data_hash'])
+        os.rename(part_fp, ckpt_fp)
+
+    def load_checkpoint(self, ckpt_fp, data_hash):
+        ### The training state saved in ckpt_fp, or None if there is no usable checkpoint
+        if not os.path.isfile(ckpt_fp):
+            return None
+        npzfile = np.load(ckpt_fp)
+        opt_state = npzfile['opt_state']
+        ### A leftover checkpoint of an earlier run under the same model name
+        if 'net_opts' not in npzfile.files or npzfile['net_opts'].item() != self.net_opts or \
+           'data_hash' not in npzfile.files or str(npzfile['data_hash']) != data_hash or \
+           len(opt_state) != len(self.opt_vars):
+            print('Checkpoint {} does not match this training. Start from scratch.'.format(ckpt_fp))
+            return None
+        self.set_param_values(npzfile['params'])
+        for v, val in zip(self.opt_vars, opt_state):
+            v.set_value(val)
+        return {'epoch': int(npzfile['epoch']), 'lowest_loss': float(npzfile['lowest_loss']),
+                'bad_epochs': int(npzfile['bad_epochs']), 'perm': npzfile['perm'], 'data_hash': data_hash}
 
     def test(self, feature_list):
         # MUST BE OVERRIDDEN
         return None
 
-    def run(self, feature_list):
+    def run(self, feature_list, batch_size=None, batch_bytes=None):
+        """
+        Predict the class probabilities of extracted features.
+
+        Parameters
+        ----------
+        feature_list: list of tuples (input_1, ..., input_k, file_name)
+        batch_size: int, maximum number of elements per batch
+        batch_bytes: int, maximum size of the float32 inputs of a batch in bytes
+            (both default to RUN_BATCH_SIZE and RUN_BATCH_BYTES)
+
+        Returns
+        -------
+        pred_list: np.ndarray, shape=(len(feature_list), num_class)
+        """
+        if len(feature_list) == 0:
+            return np.zeros((0, self.net_opts['num_class']))
+        shapes = [np.shape(inp) for inp in feature_list[0][:-1]]
+        sample_bytes = sum(int(np.prod(sh)) for sh in shapes) * np.dtype('float32').itemsize
+        batch_size = Model.run_batch_size(sample_bytes, batch_size, batch_bytes)
+        n_rows = min(batch_size, len(feature_list))
+        ### Fill preallocated contiguous buffers. Inference models pad a short batch 
+        ### with zeros up to a power of two, so run_fn only sees a few input shapes; 
+        ### other models run it unpadded, since padding would change BatchNorm statistics
+        bufs = [np.zeros((n_rows,) + sh, dtype='float32') for sh in shapes]
         pred_list = []
-        for bt in self.iterate_minibatches(feature_list, 10):
-            feat, fn = zip(*bt)
-            pred = self.run_fn(list(feat))
-            pred_list += pred[0].tolist()
-        pred_list = np.array(pred_list)
-        return pred_list
+        for start_idx in range(0, len(feature_list), n_rows):
+            bt = feature_list[start_idx:start_idx + n_rows]
+            n_run = Model.run_bucket_size(len(bt), n_rows) if self.inference_only else len(bt)
+            for i, buf in enumerate(bufs):
+                for k, feat in enumerate(bt):
+                    buf[k] = feat[i]
+                buf[len(bt):n_run] = 0.0
+            with self.run_lock:
+                pred = self.run_fn(*[buf[:n_run] for buf in bufs])
+            pred_list.append(pred[0][:len(bt)])
+        return np.concatenate(pred_list, axis=0)
+
+    @staticmethod
+    def run_bucket_size(n, max_size):
+        ### Smallest power of two >= n, at most max_size
+        size = 1
+        while size < n:
+            size *= 2
+        return min(size, max_size)
+
+    @staticmethod
+    def run_batch_size(sample_bytes, batch_size=None, batch_bytes=None):
+        if batch_size is None and batch_bytes is None:
+            batch_size, batch_bytes = RUN_BATCH_SIZE, RUN_BATCH_BYTES
+        if batch_bytes is not None:
+            max_size = max(1, int(batch_bytes // sample_bytes))
+            batch_size = max_size if batch_size is None else min(batch_size, max_size)
+        return max(1, int(batch_size))
 
     def set_param_values(self, val):
         lasagne.layers.set_all_param_values(self.network, val)
@@ -204,21 +536,59 @@ class Model(object):
                           params=params)
 
     @staticmethod
-    def init_from_file(model_fp):
+    def init_from_file(model_fp, inference_only=False):
         npzfile = np.load(model_fp)
         print npzfile['class_name']
         model_class = globals()[npzfile['class_name'].item()]
-        model = model_class(npzfile['net_opts'].item(), model_fp)
+        model = model_class(npzfile['net_opts'].item(), model_fp, inference_only)
         model.set_param_values(npzfile['params'])
         return model
 
+#===== MODEL REGISTRY =====#
+
+### Models loaded by load_model(), keyed by (absolute path, mtime, inference_only)
+_model_registry = {}
+_model_registry_lock = threading.Lock()
+
+def load_model(model_fp, inference_only=True):
+    """
+    Get the model stored in model_fp, loading the file and compiling its
+    functions only once per process. A model file that has been modified
+    since it was loaded is loaded again.
+
+    Parameters
+    ----------
+    model_fp: str, the filepath of the .npz model file
+    inference_only: bool, skip compiling the training and validation functions
+
+    Returns
+    -------
+    model: Model, shared with every other caller asking for the same file
+    """
+    fp = os.path.abspath(model_fp)
+    key = (fp, os.path.getmtime(fp), inference_only)
+    with _model_registry_lock:
+        model = _model_registry.get(key)
+        if model is None:
+            for k in [k for k in _model_registry if k[0] == fp and k[1] != key[1]]:
+                del _model_registry[k]
+            model = Model.init_from_file(fp, inference_only)
+            _model_registry[key] = model
+    return model
+
+def clear_model_registry():
+    with _model_registry_lock:
+        _model_registry.clear()
+
 ##### MLP Network
 class DNNModel(Model):
     def init_model(self):
         print('Initializing model...')
         mfcc_input_var = T.tensor3('mfcc_input')
-        target_var = T.imatrix('targets')
         network = self.build_network(mfcc_input_var)
+        if self.inference_only:
+            return self.init_inference_model([mfcc_input_var])
+        target_var = T.imatrix('targets')
         prediction = layers.get_output(network)
         prediction = T.clip(prediction, 1e-7, 1.0 - 1e-7)
         loss = lasagne.objectives.categorical_crossentropy(prediction, target_var)
@@ -226,6 +596,7 @@ class DNNModel(Model):
         params = layers.get_all_params(network, trainable=True)
         # updates = lasagne.updates.adagrad(loss, params, learning_rate=0.002)
         updates = lasagne.updates.sgd(loss, params, learning_rate=0.02)
+        self.opt_vars = Model.optimizer_vars(updates, params)
 
         test_prediction = layers.get_output(network, deterministic=True)
         test_loss = lasagne.objectives.categorical_crossentropy(test_prediction,
@@ -251,15 +622,16 @@ class DNNModel(Model):
         test_acc = 0
         test_batches = 0
         ans_list, pred_list = [], []
-        for bt in self.iterate_minibatches(feature_list, 10):
-            feat, ans, fn = zip(*bt)
-            err, acc, pred = self.val_fn(list(feat), list(ans))
+        for bt in self.iterate_minibatches(feature_list, self.batch_size):
+            feat, ans, fn = bt
+            err, acc, pred = self.val_fn(feat, ans)
             test_err += err
             test_acc += acc
             test_batches += 1
             for a, p in zip(ans, pred):
                 ans_list.append(np.argmax(a))
                 pred_list.append(np.argmax(p))
+        from sklearn.metrics import confusion_matrix
         confusion_mat = confusion_matrix(ans_list, pred_list)
         print("  test loss:\t\t{:.6f}".format(test_err / test_batches))
         print("  test accuracy:\t\t{:.2f} %".format(test_acc / test_batches * 100))
@@ -270,9 +642,9 @@ class DNNModel(Model):
     def train_one(self, train_list):
         train_err = 0
         train_batches = 0
-        for bt in self.iterate_minibatches(train_list, 10):
-            feat, ans, fn = zip(*bt)
-            err, pred = self.train_fn(list(feat), list(ans))
+        for bt in self.iterate_minibatches(train_list, self.batch_size, shuffle=True):
+            feat, ans, fn = bt
+            err, pred = self.train_fn(feat, ans)
             # if random.randint(0, 19) == 0:
             #   print 'err', err
             #   print 'pred', pred
@@ -284,9 +656,9 @@ class DNNModel(Model):
         val_err = 0
         val_acc = 0
         val_batches = 0
-        for bt in self.iterate_minibatches(val_list, 10):
-            feat, ans, fn = zip(*bt)
-            err, acc, pred = self.val_fn(list(feat), list(ans))
+        for bt in self.iterate_minibatches(val_list, self.batch_size):
+            feat, ans, fn = bt
+            err, acc, pred = self.val_fn(feat, ans)
             val_err += err
             val_acc += acc
             val_batches += 1
@@ -420,14 +792,17 @@ class RawDNNModel(Model, RawFeature):
         print('Initializing model...')
         ra_input_var = T.tensor3('raw_audio_input')
         mc_input_var = T.tensor3('melody_contour_input')
-        target_var = T.imatrix('targets')
         network = self.build_network(ra_input_var, mc_input_var)
+        if self.inference_only:
+            return self.init_inference_model([ra_input_var, mc_input_var])
+        target_var = T.imatrix('targets')
         prediction = layers.get_output(network)
         prediction = T.clip(prediction, 1e-7, 1.0 - 1e-7)
         loss = lasagne.objectives.categorical_crossentropy(prediction, target_var)
         loss = loss.mean()
         params = layers.get_all_params(network, trainable=True)
         updates = lasagne.updates.adagrad(loss, params, learning_rate=0.002)
+        self.opt_vars = Model.optimizer_vars(updates, params)
         # updates = lasagne.updates.sgd(loss, params, learning_rate=0.02)
 
         test_prediction = layers.get_output(network, deterministic=True)
@@ -485,15 +860,16 @@ class RawDNNModel(Model, RawFeature):
         test_acc = 0
         test_batches = 0
         ans_list, pred_list = [], []
-        for bt in self.iterate_minibatches(feature_list, 10):
-            raw, mc, ans, fn = zip(*bt)
-            err, acc, pred = self.val_fn(list(raw), list(mc), list(ans))
+        for bt in self.iterate_minibatches(feature_list, self.batch_size):
+            raw, mc, ans, fn = bt
+            err, acc, pred = self.val_fn(raw, mc, ans)
             test_err += err
             test_acc += acc
             test_batches += 1
             for a, p in zip(ans, pred):
                 ans_list.append(np.argmax(a))
                 pred_list.append(np.argmax(p))
+        from sklearn.metrics import confusion_matrix
         confusion_mat = confusion_matrix(ans_list, pred_list)
         print("  test loss:\t\t{:.6f}".format(test_err / test_batches))
         print("  test accuracy:\t\t{:.2f} %".format(test_acc / test_batches * 100))
@@ -504,9 +880,9 @@ class RawDNNModel(Model, RawFeature):
     def train_one(self, train_list):
         train_err = 0
         train_batches = 0
-        for bt in self.iterate_minibatches(train_list, 10):
-            raw, mc, ans, fn = zip(*bt)
-            err, pred = self.train_fn(list(raw), list(mc), list(ans))
+        for bt in self.iterate_minibatches(train_list, self.batch_size, shuffle=True):
+            raw, mc, ans, fn = bt
+            err, pred = self.train_fn(raw, mc, ans)
             # if random.randint(0, 19) == 0:
             #   print 'pred', pred
                 # print 'll', ll
@@ -518,9 +894,9 @@ class RawDNNModel(Model, RawFeature):
         val_err = 0
         val_acc = 0
         val_batches = 0
-        for bt in self.iterate_minibatches(val_list, 10):
-            raw, mc, ans, fn = zip(*bt)
-            err, acc, pred = self.val_fn(list(raw), list(mc), list(ans))
+        for bt in self.iterate_minibatches(val_list, self.batch_size):
+            raw, mc, ans, fn = bt
+            err, acc, pred = self.val_fn(raw, mc, ans)
             val_err += err
             val_acc += acc
             val_batches += 1
@@ -532,14 +908,17 @@ class RawNetModel(Model, RawFeature):
         print('Initializing model...')
         ra_input_var = T.tensor3('raw_audio_input')
         mc_input_var = T.tensor3('melody_contour_input')
-        target_var = T.imatrix('targets')
         network = self.build_network(ra_input_var, mc_input_var)
+        if self.inference_only:
+            return self.init_inference_model([ra_input_var, mc_input_var])
+        target_var = T.imatrix('targets')
         prediction = layers.get_output(network)
         prediction = T.clip(prediction, 1e-7, 1.0 - 1e-7)
         loss = lasagne.objectives.categorical_crossentropy(prediction, target_var)
         loss = loss.mean()
         params = layers.get_all_params(network, trainable=True)
         updates = lasagne.updates.sgd(loss, params, learning_rate=0.02)
+        self.opt_vars = Model.optimizer_vars(updates, params)
 
         test_prediction = layers.get_output(network, deterministic=True)
         test_loss = lasagne.objectives.categorical_crossentropy(test_prediction,
@@ -603,17 +982,16 @@ class RawNetModel(Model, RawFeature):
         test_acc = 0
         test_batches = 0
         ans_list, pred_list = [], []
-        for ra, mc, ans, fi in feature_list:
-            ra = ra.reshape((1,1,-1))
-            mc = mc.reshape((1,2,-1))
-            ans = np.array([ans], dtype='int32')
-            err, acc, pred = self.val_fn(ra, mc, ans)
+        for bt in self.iterate_minibatches(feature_list, self.batch_size):
+            raw, mc, ans, fn = bt
+            err, acc, pred = self.val_fn(raw, mc, ans)
             test_err += err
             test_acc += acc
             test_batches += 1
             for a, p in zip(ans, pred):
                 ans_list.append(np.argmax(a))
                 pred_list.append(np.argmax(p))
+        from sklearn.metrics import confusion_matrix
         confusion_mat = confusion_matrix(ans_list, pred_list)
         print("  test loss:\t\t{:.6f}".format(test_err / test_batches))
         print("  test accuracy:\t\t{:.2f} %".format(test_acc / test_batches * 100))
@@ -624,14 +1002,9 @@ class RawNetModel(Model, RawFeature):
     def train_one(self, train_list):
         train_err = 0
         train_batches = 0
-        for ra, mc, ans, fi in train_list:
-            ra = ra.reshape((1,1,-1))
-            mc = mc.reshape((1,2,-1))
-            ans = np.array([ans], dtype='int32')
-            err, pred = self.train_fn(ra, mc, ans)
-            # if random.randint(0, 19) == 0:
-            #   print 'pred', pred
-                # print 'll', ll
+        for bt in self.iterate_minibatches(train_list, self.batch_size, shuffle=True):
+            raw, mc, ans, fn = bt
+            err, pred = self.train_fn(raw, mc, ans)
             train_err += err
             train_batches += 1
         return train_err, train_batches
@@ -640,11 +1013,9 @@ class RawNetModel(Model, RawFeature):
         val_err = 0
         val_acc = 0
         val_batches = 0
-        for ra, mc, ans, fi in val_list:
-            ra = ra.reshape((1,1,-1))
-            mc = mc.reshape((1,2,-1))
-            ans = np.array([ans], dtype='int32')
-            err, acc, pred = self.val_fn(ra, mc, ans)
+        for bt in self.iterate_minibatches(val_list, self.batch_size):
+            raw, mc, ans, fn = bt
+            err, acc, pred = self.val_fn(raw, mc, ans)
             val_err += err
             val_acc += acc
             val_batches += 1
@@ -27,7 +27,7 @@ class Note(object):
         return self.arr.copy()
 
     def add_tech(self, tech):
-        self.arr[tech.t_type] = tech.value
+        self.set_tech_value(tech.t_type, tech.value)
 
     def equal_tech(self, other):
         return (self.arr[3:] == other.array_repr()[3:]).all()
@@ -65,17 +65,22 @@ class Note(object):
 
     @property
     def all_techs(self):
-        return [Tech(idx+3, t) for idx, t in enumerate(self.arr[3:])]
+        return [Tech(t, self.arr[t]) for t in TECH_COLUMNS]
 
     def tech(self, t_num):
-        if t_num in range(3, 12):
-            return Tech(t_num, self.arr[t_num])
+        return Tech(t_num, self.tech_value(t_num))
+
+    def tech_value(self, t_num):
+        ### Same as tech(t_num).value, but without building a Tech object
+        if T_PREBEND <= t_num < T_NORMAL:
+            return self.arr[t_num]
         elif t_num == T_NORMAL:
-            value = 1 if np.count_nonzero(self.arr[3:]) == 0 else 0
-            return Tech(t_num, value)
+            return 0 if self.arr[3:].any() else 1
         else:
             raise ValueError('ERROR: number of tech should be 3 ~ 12, not {}.'.format(t_num))
-            return None
+
+    def set_tech_value(self, t_num, value):
+        self.arr[t_num] = value
 
     def merge_note(self, other):
         nt = Note.merge(self, other)
@@ -157,6 +162,15 @@ class DiscreteNote(Note):
         ratio = float(hop_size) / float(sr)
         return Note(self.pitch, self.onset*ratio, self.duration*ratio, self.all_techs)
 
+def discrete_to_cont_array(notes, hop_size, sr):
+    """
+    Convert a sequence of discrete notes into one (n, 12) float array 
+    in seconds, without building an intermediate Note per element.
+    """
+    arr = np.array([nt.arr for nt in notes], dtype=float).reshape((-1, 12))
+    arr[:, 1:3] *= float(hop_size) / float(sr)
+    return arr
+
 class CandidateNote(DiscreteNote):
     def __init__(self, pitch=0, onset=0, duration=0, next_note=None,
                  techs=[], segs=None, array=None, note=None):
@@ -189,4 +203,81 @@ class CandidateNote(DiscreteNote):
         elif note.onset == second.onset and len(first.segs) > 0:
             note.segs += [Segment(seg.val, seg.pos + first.onset - second.onset, seg.length, ref_con=seg.ref_con) for seg in first.segs]
             note.next_note = first.next_note
-        return note
\ No newline at end of file
+        return note
+
+class NoteSequence(object):
+    """
+    Ordered sequence of notes with O(1) membership test and deletion.
+
+    Notes are chained in a doubly linked list keyed by object identity, 
+    so removing a note (e.g. after merging it into its predecessor) does 
+    not shift the rest of the sequence as list.remove() does.
+    """
+    def __init__(self, notes=None):
+        self.__prev = {}
+        self.__next = {}
+        self.__notes = {}
+        self.__head = None
+        self.__tail = None
+        for nt in (notes or []):
+            self.append(nt)
+
+    def __len__(self):
+        return len(self.__notes)
+
+    def __contains__(self, note):
+        return id(note) in self.__notes
+
+    def __iter__(self):
+        ### Only the note just yielded may be removed while iterating
+        key = self.__head
+        while key is not None:
+            nxt = self.__next[key]
+            yield self.__notes[key]
+            key = self.__next[key] if key in self.__notes else nxt
+
+    def __repr__(self):
+        return 'NoteSequence(' + repr(list(self)) + ')'
+
+    def append(self, note):
+        key = id(note)
+        if key in self.__notes:
+            raise ValueError('Note {} is already in the sequence.'.format(note))
+        self.__notes[key] = note
+        self.__prev[key] = self.__tail
+        self.__next[key] = None
+        if self.__tail is None:
+            self.__head = key
+        else:
+            self.__next[self.__tail] = key
+        self.__tail = key
+
+    def remove(self, note):
+        key = id(note)
+        if key not in self.__notes:
+            raise ValueError('Note {} is not in the sequence.'.format(note))
+        prv, nxt = self.__prev.pop(key), self.__next.pop(key)
+        if prv is None: self.__head = nxt
+        else: self.__next[prv] = nxt
+        if nxt is None: self.__tail = prv
+        else: self.__prev[nxt] = prv
+        del self.__notes[key]
+
+    def discard(self, note):
+        if note in self:
+            self.remove(note)
+
+    def successor(self, note):
+        key = self.__next[id(note)]
+        return None if key is None else self.__notes[key]
+
+    def merge_next(self, note, other=None):
+        """
+        Merge other (the successor of note by default) into note in place 
+        and drop it from the sequence.
+        """
+        if other is None:
+            other = self.successor(note)
+        self.discard(other)
+        note.merge_note(other)
+        return note
@@ -15,6 +15,28 @@ inv_tech_dict = { D_ASCENDING: {v: k for k, v in tech_dict[D_ASCENDING].iteritem
                   D_DESCENDING: {v: k for k, v in tech_dict[D_DESCENDING].iteritems()}
                 }
 
+### Default batch size of Model.run, by number of candidates and/or by bytes 
+### of float32 input (None for no limit)
+RUN_BATCH_SIZE = 64
+RUN_BATCH_BYTES = None
+
+### Minibatch size of training, validation and testing (Model.batch_size)
+TRAIN_BATCH_SIZE = 10
+
+### Stop training after this many epochs without a lower validation loss (None 
+### to always train all epochs), overridden by Model.train(patience=...)
+TRAIN_PATIENCE = None
+### Save a training checkpoint every this many epochs (0 to disable)
+CHECKPOINT_EVERY = 1
+
+### Ranges of the random augmentations of training clips (see augmentation.py)
+aug_opts = {
+    'pitch_shift': 1.0,             # semitones
+    'gain_db': 6.0,
+    'time_offset': 2,               # frames
+    'noise_snr_db': (20.0, 40.0),
+}
+
 old_raw_net_opts = {
     'ra_conv_1': {
         'num_filters': 256,
@@ -134,6 +156,9 @@ cv_list =  [[5, 17, 32, 50, 55, 57, 58, 65, 70],
 MC_LENGTH = 25
 HOP_LENGTH = 256
 SAMPLING_RATE = 44100
+### Audio samples of a candidate clip, which spans about MC_LENGTH frames; training 
+### clips are padded or cropped to it by features of raw audio (RawFeature)
+CLIP_LENGTH = int(round(0.14 * SAMPLING_RATE))
 frameSize = 2048
 guessUnvoiced = True
 binResolution = 10
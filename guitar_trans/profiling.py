@@ -0,0 +1,84 @@
+"""
+Opt-in instrumentation for the transcription pipeline.
+--------------------------------------------------------------------------------
+A Profiler accumulates wall-clock time per named stage and integer counters,
+and dumps them as a JSON profile:
+
+    prof = Profiler('lick_29')
+    with prof.timer('note_tracking'):
+        ...
+    prof.count('candidates.ascending', 12)
+    prof.save('outputs/lick_29/Profile.json')
+
+Functions taking an optional profiler fall back to NULL_PROFILER, whose
+methods do nothing, so uninstrumented runs pay no bookkeeping cost.
+--------------------------------------------------------------------------------
+"""
+import json, threading
+from contextlib import contextmanager
+from timeit import default_timer
+
+class Profiler(object):
+    def __init__(self, name=None):
+        self.name = name
+        self.times = {}
+        self.calls = {}
+        self.counters = {}
+        self.__lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, key):
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.add_time(key, default_timer() - start)
+
+    def add_time(self, key, secs):
+        with self.__lock:
+            self.times[key] = self.times.get(key, 0.0) + secs
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def count(self, key, n=1):
+        with self.__lock:
+            self.counters[key] = self.counters.get(key, 0) + int(n)
+
+    def merge(self, profile, base=None):
+        ### Add the times and counters of profile (a to_dict() result) beyond those of base,
+        ### e.g. what a forked process added to a copy of this profiler
+        base_stages = base['stages'] if base else {}
+        base_counters = base['counters'] if base else {}
+        with self.__lock:
+            for k, st in profile['stages'].items():
+                b = base_stages.get(k, {'seconds': 0.0, 'calls': 0})
+                if st['calls'] > b['calls']:
+                    self.times[k] = self.times.get(k, 0.0) + st['seconds'] - b['seconds']
+                    self.calls[k] = self.calls.get(k, 0) + st['calls'] - b['calls']
+            for k, n in profile['counters'].items():
+                if n != base_counters.get(k, 0):
+                    self.counters[k] = self.counters.get(k, 0) + n - base_counters.get(k, 0)
+
+    def to_dict(self):
+        with self.__lock:
+            stages = dict((k, {'seconds': self.times[k], 'calls': self.calls[k]}) for k in self.times)
+            return {'name': self.name, 'stages': stages, 'counters': dict(self.counters)}
+
+    def save(self, save_fp):
+        with open(save_fp, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+
+class NullProfiler(Profiler):
+    @contextmanager
+    def timer(self, key):
+        yield
+
+    def add_time(self, key, secs):
+        pass
+
+    def count(self, key, n=1):
+        pass
+
+    def merge(self, profile, base=None):
+        pass
+
+NULL_PROFILER = NullProfiler()
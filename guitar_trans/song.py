@@ -22,7 +22,7 @@ class Song:
 				if tech.t_type in [T_PULL, T_HAMMER, T_SLIDE]:
 					if tech.value == 1 and i < len(self.es_note_list): 
 						n_esn = self.es_note_list[i+1]
-						if n_esn.tech(tech.t_type) == 2:
+						if n_esn.tech_value(tech.t_type) == 2:
 							ts_list = np.vstack([ts_list, [esn.onset, n_esn.offset, tech.t_type]])
 				else: ts_list = np.vstack([ts_list, [esn.onset, esn.offset, tech.t_type]])
 		return ts_list
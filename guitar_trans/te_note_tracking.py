@@ -4,7 +4,7 @@ import parameters as pm
 from contour import *
 from technique import *
 from note import *
-from scipy.stats import norm
+from profiling import NULL_PROFILER
 from os import sep
 
 #=====Parameters=====#
@@ -18,7 +18,9 @@ max_cand_diff=3.5
 max_cs_amp=3.0
 max_cs_length=33
 
-nf_weights = np.array([norm.pdf(i, scale=2) for i in range(-5, 6)])
+### Gaussian pdf with a standard deviation of 2 (scipy.stats.norm.pdf(x, scale=2))
+_nf_x = np.arange(-5, 6) / 2.0
+nf_weights = np.exp(-_nf_x**2 / 2.0) / np.sqrt(2 * np.pi) / 2.0
 nf_weights /= nf_weights.sum()
 
 def conditioned_norm_filter(data):
@@ -52,7 +54,7 @@ def conditioned_mean_filter(data, filter_size=5):
     return new_data
 
 ### Technique Embedded Note Tracking
-def tent(melody, debug=None):
+def tent(melody, debug=None, profiler=NULL_PROFILER):
     if melody.length == 0:
         print 'Nothing in melody. (Length of melody is 0.)'
         return
@@ -87,13 +89,18 @@ def tent(melody, debug=None):
     if len(submelo) >= min_melo_len:
         ct = Contour(sub_idx, submelo)
         submelo_list.append(ct)
+    profiler.count('submelodies', len(submelo_list))
 
     trend = np.zeros(melody.length)
     if debug is not None: mid_trend = np.zeros(melody.length)
     # n_melo = melody.sub_contour(range(melody.length))
     notes = []
+    ### Find the extrema of all submelodies at once
+    sub_offsets = np.r_[0, np.cumsum([subm.length for subm in submelo_list])]
+    sub_buf = np.concatenate([subm.seq for subm in submelo_list]) if submelo_list else []
+    extrema, ext_offsets = get_extrema_batch(sub_buf, sub_offsets)
     for idx, subm in enumerate(submelo_list):
-        tr = melody_2_trend(subm)
+        tr = melody_2_trend(subm, extrema[ext_offsets[idx]:ext_offsets[idx+1]])
         if debug is not None: mid_trend[subm.start_idx:subm.start_idx+len(tr)] = list(tr)
         nt = get_notes(subm, tr)
         ### Add candidate between submelodies
@@ -112,19 +119,19 @@ def tent(melody, debug=None):
         np.savetxt(debug+sep+'MidTrend.txt', mid_trend)
     return trend, melody, notes
 
-def melody_2_trend(melody):
-    extrema = get_extrema(melody.seq)
+def melody_2_trend(melody, extrema=None):
+    if extrema is None:
+        extrema = get_extrema(melody.seq)
     ### If the difference in this melody is smaller than min_vib_amp, 
     ### return a single, nontechnical note.
-    if max(extrema[:,1]) - min(extrema[:,1]) < min_vib_amp:
+    if extrema['value'].max() - extrema['value'].min() < min_vib_amp:
         return [0] * melody.length
 
     ### Record the trend (ascending, descending, or horizontal)
     trend = np.zeros(melody.length)
+    ext_idx = extrema['index']
     for i in range(len(extrema)-1):
-        j, j_val, _ = extrema[i]
-        k, k_val, _ = extrema[i+1]
-        j, k = int(j), int(k)
+        j, k = int(ext_idx[i]), int(ext_idx[i+1])
         pattern = Contour(j, melody[j:k])
         trend[j:k] = scan_pattern_trend(pattern, melody[int(k)])
     trend[-1] = trend[-2] 
@@ -267,26 +274,33 @@ def estimate_notes(melo, cands, slide_in, slide_out):
         return create_vibrato_note(melo, seg, slide_in, slide_out)
 
 def merge_notes(notes):
-    for i in range(len(notes)-1, 0, -1):
-        nt = notes[i-1]
+    if len(notes) < 2: return
+    ### Walk backwards once, collecting the surviving notes in reverse order,
+    ### so that merging never has to shift the rest of the list.
+    merged = [notes[-1]]
+    for i in range(len(notes)-2, -1, -1):
+        nt, back = notes[i], merged[-1]
         ### Merge notes if there is bend or release
-        if (nt.tech(T_BEND).value > 0 and \
-            nt.offset == notes[i].onset and \
-            nt.pitch + nt.tech(T_BEND).value == notes[i].pitch) or \
-           (nt.tech(T_RELEASE).value > 0 and \
-            nt.offset == notes[i].onset and \
-            nt.pitch == notes[i].pitch):
-            notes[i-1] = CandidateNote.merge(nt, notes[i])
-            notes.remove(notes[i])
-        elif nt.tech(T_SLIDE).value == 1:
-            t_val = 3 if notes[i].tech(T_SLIDE).value in (1, 3) else 2
-            notes[i].add_tech(Tech(T_SLIDE, t_val))
-        elif nt.tech(T_HAMMER).value == 1:
-            t_val = 3 if notes[i].tech(T_HAMMER).value in (1, 3) else 2
-            notes[i].add_tech(Tech(T_HAMMER, t_val))
-        elif nt.tech(T_PULL).value == 1:
-            t_val = 3 if notes[i].tech(T_PULL).value in (1, 3) else 2
-            notes[i].add_tech(Tech(T_PULL, t_val))
+        if (nt.tech_value(T_BEND) > 0 and \
+            nt.offset == back.onset and \
+            nt.pitch + nt.tech_value(T_BEND) == back.pitch) or \
+           (nt.tech_value(T_RELEASE) > 0 and \
+            nt.offset == back.onset and \
+            nt.pitch == back.pitch):
+            merged[-1] = CandidateNote.merge(nt, back)
+            continue
+        elif nt.tech_value(T_SLIDE) == 1:
+            t_val = 3 if back.tech_value(T_SLIDE) in (1, 3) else 2
+            back.set_tech_value(T_SLIDE, t_val)
+        elif nt.tech_value(T_HAMMER) == 1:
+            t_val = 3 if back.tech_value(T_HAMMER) in (1, 3) else 2
+            back.set_tech_value(T_HAMMER, t_val)
+        elif nt.tech_value(T_PULL) == 1:
+            t_val = 3 if back.tech_value(T_PULL) in (1, 3) else 2
+            back.set_tech_value(T_PULL, t_val)
+        merged.append(nt)
+    merged.reverse()
+    notes[:] = merged
 
 def has_slide_in(melo, slide_in):
     """
@@ -463,35 +477,78 @@ def get_note_with_seg(pitch, start_idx, length, techs, seg):
 
 
 
-def _generate_extrema(y, y_cond, etype):
-    ### Extract extrema from pruned matrix and add the extrema type to the matrix
-    e = y[np.extract(y_cond, range(len(y_cond)))]
-    ### np.full is faster than np.vstack
-    ext = np.full((e.shape[0], e.shape[-1]+1), float(etype))
-    ext[:,:-1] = e
-    return ext
+### Record type of get_extrema: position in the (sub-)melody, value and
+### type of the extremum (1 for maximum, -1 for minimum)
+EXTREMA_DTYPE = np.dtype([('index', int), ('value', float), ('type', np.int8)])
 
 def get_extrema(x):
+    """
+    Get the local maxima and minima of a sequence.
+
+    A plateau of repeated values counts as one point located at its first
+    index, and both end points are always reported.
+
+    Parameters
+    ----------
+    x: array-like, the sequence
+
+    Returns
+    -------
+    extrema: np.ndarray of EXTREMA_DTYPE, sorted by index
+    """
     if len(x) == 0: 
         print 'Error in get_extrema: Length of x should not be zero.'
-        return np.array([])
-    x = np.array(x)
-    ### Shrink the part of continuous same values
-    prune_cond = np.r_[True, x[1:] != x[:-1]]
-    w = np.argwhere(prune_cond).reshape(-1)
-    e = np.extract(prune_cond, x)
-    if len(e) == 1:
-        ### x contains only one value. Set the value to be a maximum.
-        return np.array([[0.0, e[0], 1.0]])
-    x_prune = np.array([w,e]).T
-    ### Extract max and min
-    max_cond = np.r_[True, x_prune[1:,-1] > x_prune[:-1,-1]] & \
-               np.r_[x_prune[1:,-1] < x_prune[:-1,-1], True]
-    x_max = _generate_extrema(x_prune, max_cond, 1.0)
-    min_cond = np.r_[True, x_prune[1:,-1] < x_prune[:-1,-1]] & \
-               np.r_[x_prune[1:,-1] > x_prune[:-1,-1], True]
-    x_min = _generate_extrema(x_prune, min_cond, -1.0)
-    ### Concatenate max min and sort with original args
-    x_ext = np.concatenate((x_max, x_min), axis=0)
-    x_ext = x_ext[x_ext[:,0].argsort()]
-    return x_ext
+        return np.zeros(0, dtype=EXTREMA_DTYPE)
+    extrema, _ = get_extrema_batch(x, [0, len(x)])
+    return extrema
+
+def get_extrema_batch(buf, offsets):
+    """
+    Get the extrema of many sequences stored back to back in one buffer,
+    in a single vectorized pass.
+
+    Parameters
+    ----------
+    buf: array-like, the concatenated sequences
+    offsets: array-like, shape=(n_seq+1,), sequence i is buf[offsets[i]:offsets[i+1]]
+
+    Returns
+    -------
+    extrema: np.ndarray of EXTREMA_DTYPE, extrema of all sequences in order,
+             with indices relative to the start of their own sequence
+    ext_offsets: np.ndarray, shape=(n_seq+1,), the extrema of sequence i are
+                 extrema[ext_offsets[i]:ext_offsets[i+1]]
+    """
+    offsets = np.asarray(offsets, dtype=int)
+    x = np.asarray(buf, dtype=float)[offsets[0]:offsets[-1]]
+    offsets = offsets - offsets[0]
+    lengths = np.diff(offsets)
+    seq_id = np.repeat(np.arange(len(lengths)), lengths)
+    is_start = np.zeros(len(x), dtype=bool)
+    is_start[offsets[:-1][lengths > 0]] = True
+
+    ### Shrink the part of continuous same values, never across sequences
+    keep = is_start.copy()
+    keep[1:] |= x[1:] != x[:-1]
+    w = np.flatnonzero(keep)
+    e = x[w]
+    first = is_start[w]
+    last = np.r_[first[1:], True]
+
+    ### A point is a maximum if it rises from its predecessor and falls to 
+    ### its successor; the ends of each sequence only need one neighbour.
+    rise = e[1:] > e[:-1]
+    fall = e[1:] < e[:-1]
+    is_max = (first | np.r_[False, rise]) & (last | np.r_[fall, False])
+    is_min = (first | np.r_[False, fall]) & (last | np.r_[rise, False])
+    etype = np.where(is_max, 1, np.where(is_min, -1, 0))
+
+    sel = np.flatnonzero(etype)
+    pos = w[sel]
+    extrema = np.empty(len(sel), dtype=EXTREMA_DTYPE)
+    extrema['index'] = pos - offsets[seq_id[pos]]
+    extrema['value'] = e[sel]
+    extrema['type'] = etype[sel]
+    counts = np.bincount(seq_id[pos], minlength=len(lengths))
+    ext_offsets = np.r_[0, np.cumsum(counts)].astype(int)
+    return extrema, ext_offsets
@@ -20,7 +20,12 @@ T_STR_DICT = {  T_NORMAL: 'Normal',
 				T_SLIDE_OUT: 'Slide-out',
 				T_VIBRATO: 'Vibrato'}
 
+### Indices of the technique columns in a note array, i.e. every type but T_NORMAL
+TECH_COLUMNS = range(T_PREBEND, T_NORMAL)
+
 class Tech(object):
+	__slots__ = ('t_type', 'value')
+
 	def __init__(self, t_type=T_NORMAL, value=0):
 		if t_type > T_NORMAL or t_type < T_PREBEND: 
 			print('ERROR: No Tech type {}. Will assign to normal type(12).'.format(t_type))
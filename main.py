@@ -1,101 +1,157 @@
-import librosa as rosa
+### librosa, the models (Theano), MELODIA (essentia) and the evaluation (mir_eval)
+### are imported where they are used, so e.g. --help or a run with a given
+### melody contour does not pay for the dependencies it does not need.
 import numpy as np
 import guitar_trans.te_note_tracking as note_tracking
 import guitar_trans.parameters as pm
-from guitar_trans import models
 from guitar_trans.song import *
 from guitar_trans.note import *
 from guitar_trans.contour import *
 from guitar_trans.technique import *
-from guitar_trans.evaluation import evaluation_note, evaluation_esn, evaluation_ts
-from melody_extraction import extract_melody
-from os import path, sep, makedirs
+from guitar_trans.profiling import Profiler, NULL_PROFILER
+from multiprocessing import Pool
+from os import path, sep, makedirs, listdir
+import csv, sys, time, traceback
 
-N_BIN = int(round(0.14 * 44100))
+N_BIN = pm.CLIP_LENGTH
 N_FRAME = pm.MC_LENGTH
 
-def transcribe(audio, melody, asc_model_fp, desc_model_fp, save_dir, audio_fn):
+def transcribe(audio, melody, asc_model_fp, desc_model_fp, save_dir, audio_fn, profiler=NULL_PROFILER, song_features=False):
+    notes = track_notes(melody, save_dir, profiler)
+    cand_dict, cand_results = extract_candidates(notes, audio, melody, audio_fn, profiler)
+    no_next = []
+    ### Whole-song feature maps shared by both directions, if enabled
+    song_fmaps = {} if song_features else None
+    for direction in cand_dict:
+        cand_list = cand_dict[direction]
+        profiler.count('candidates.' + direction, len(cand_list))
+        if len(cand_list) == 0: continue
+        model_fp = asc_model_fp if direction == pm.D_ASCENDING else desc_model_fp
+        pred_list = classification(model_fp, cand_list, profiler, audio, song_fmaps)
+        print ('Processing direction', direction)
+        apply_predictions(notes, direction, cand_list, pred_list, cand_results, no_next)
+    return write_results(notes, cand_results, no_next, save_dir, profiler)
+
+#=====TRANSCRIPTION STAGES=====#
+
+def track_notes(melody, save_dir, profiler=NULL_PROFILER):
     if not path.exists(save_dir): makedirs(save_dir)
     print ('  Output directory: ', '\n', '    ', save_dir)
-    trend, new_melody, notes = note_tracking.tent(melody, debug=save_dir)
-    np.savetxt(save_dir+sep+'FilteredMelody.txt', new_melody.seq, fmt='%.8f')
-    np.savetxt(save_dir+sep+'TentNotes.txt', [n.discrete_to_cont(pm.HOP_LENGTH, pm.SAMPLING_RATE).array_repr() for n in notes], fmt='%.8f')
+    profiler.count('frames', melody.length)
+    with profiler.timer('note_tracking'):
+        trend, new_melody, notes = note_tracking.tent(melody, debug=save_dir, profiler=profiler)
+    notes = NoteSequence(notes)
+    profiler.count('tent_notes', len(notes))
+    with profiler.timer('io'):
+        np.savetxt(save_dir+sep+'FilteredMelody.txt', new_melody.seq, fmt='%.8f')
+        np.savetxt(save_dir+sep+'TentNotes.txt', discrete_to_cont_array(notes, pm.HOP_LENGTH, pm.SAMPLING_RATE), fmt='%.8f')
+    return notes
+
+def extract_candidates(notes, audio, melody, audio_fn, profiler=NULL_PROFILER):
+    """
+    Cut the audio clip and melody contour around every pitch-changing segment
+    of the tracked notes.
+
+    Returns
+    -------
+    cand_dict: dict, direction -> list of (sub_audio, sub_mc, sub_fn, nt, seg, start_i, end_i)
+    cand_results: list of [onset, offset, technique], the techniques found by note tracking
+    """
     cand_dict = {pm.D_ASCENDING: [], pm.D_DESCENDING: []}
-    cand_ranges = []
     rate = float(pm.HOP_LENGTH) / float(pm.SAMPLING_RATE)
     cand_results = []
-    for nt in notes:
-        if nt.tech(T_BEND).value > 0:
-            cand_results.append([nt.onset * rate, nt.offset * rate, T_BEND])
-        if nt.tech(T_RELEASE).value > 0:
-            cand_results.append([nt.onset * rate, nt.offset * rate, -T_RELEASE])
-        if nt.tech(T_SLIDE_IN).value > 0:
-            cand_results.append([nt.onset * rate, nt.offset * rate, T_SLIDE_IN])
-        if nt.tech(T_SLIDE_OUT).value > 0:
-            cand_results.append([nt.onset * rate, nt.offset * rate, T_SLIDE_OUT])
-        if nt.tech(T_VIBRATO).value > 0:
-            cand_results.append([nt.onset * rate, nt.offset * rate, T_VIBRATO])
-        for seg in nt.segs:
-            mid_frame = nt.onset + seg.mid
-            mid_bin = int(float(mid_frame) / rate)
-            start_i, end_i = mid_frame - N_FRAME/2, mid_frame + N_FRAME - N_FRAME/2
-            start_bin = start_i * pm.HOP_LENGTH
-            sub_audio = audio[start_bin: start_bin + N_BIN]
-            sub_mc = melody[start_i: end_i]
-            assert(len(sub_audio) == N_BIN)
-            assert(len(sub_mc) == N_FRAME)
-            sub_fn = audio_fn + '_' + str(mid_frame)
-            direction = pm.D_ASCENDING if seg.val >= 0 else pm.D_DESCENDING
-            cand_dict[direction].append((sub_audio, sub_mc, sub_fn, nt, seg, start_i, end_i))
-            # rosa.output.write_wav('trans/audio/clip_'+sub_fn+'.wav', sub_audio, sr=pm.SAMPLING_RATE, norm=False)
-    no_next = []
-    for direction in cand_dict:
-        print ('Processing direction', direction)
-        cand_list = cand_dict[direction]
-        model_fp = asc_model_fp if direction == pm.D_ASCENDING else desc_model_fp
-        if len(cand_list) > 0:
-            pred_list = classification(model_fp, [cand[:3] for cand in cand_list])
-            for pred, cand in zip(pred_list, cand_list):
-                sub_audio, sub_mc, sub_fn, nt, seg, start_i, end_i = cand
-                t_name = pm.inv_tech_dict[direction][np.argmax(pred)]
-                t_type = get_tech(t_name, direction)
-                origin_t_val = nt.tech(t_type).value
-                t_val = int(round(seg.diff())) if t_type in (T_BEND, T_RELEASE) else origin_t_val + 1
-                if t_type < T_NORMAL:
-                    ### Merge Notes
-                    if nt.next_note is None:
-                        print ('No next note. Ignore this candidate.')
-                        no_next.append([start_i * rate, end_i * rate, t_type * sign])
-                        continue
-                        # print 'next_note is None'
-                        # print nt, cand[4]
-                        # if t_type in [T_HAMMER, T_PULL, T_SLIDE]:
-                        #     print('WARNING!!! Changing {} to bend or release.'.format(t_type))
-                        #     print cand[4]
-                        #     t_type = T_BEND if direction == pm.D_ASCENDING else T_RELEASE
-                    elif t_type in [T_BEND, T_RELEASE]:
-                        if nt.next_note in notes:
-                            notes.remove(nt.next_note)
-                        nt.merge_note(nt.next_note)
-                    elif t_type in [T_HAMMER, T_PULL, T_SLIDE]:
-                        tv = nt.next_note.tech(t_type).value
-                        nt.next_note.add_tech(Tech(t_type, tv+2))
-                    nt.add_tech(Tech(t_type, t_val))
-                sign = 1 if direction == pm.D_ASCENDING else -1 
-                cand_results.append([start_i * rate, end_i * rate, t_type * sign])
-    np.savetxt(save_dir+sep+'NoNextNote.txt', no_next, fmt='%.8f')
-    np.savetxt(save_dir+sep+'CandidateResults.txt', cand_results, fmt='%.8f')
+    with profiler.timer('candidate_extraction'):
+        for nt in notes:
+            if nt.tech_value(T_BEND) > 0:
+                cand_results.append([nt.onset * rate, nt.offset * rate, T_BEND])
+            if nt.tech_value(T_RELEASE) > 0:
+                cand_results.append([nt.onset * rate, nt.offset * rate, -T_RELEASE])
+            if nt.tech_value(T_SLIDE_IN) > 0:
+                cand_results.append([nt.onset * rate, nt.offset * rate, T_SLIDE_IN])
+            if nt.tech_value(T_SLIDE_OUT) > 0:
+                cand_results.append([nt.onset * rate, nt.offset * rate, T_SLIDE_OUT])
+            if nt.tech_value(T_VIBRATO) > 0:
+                cand_results.append([nt.onset * rate, nt.offset * rate, T_VIBRATO])
+            for seg in nt.segs:
+                mid_frame = nt.onset + seg.mid
+                mid_bin = int(float(mid_frame) / rate)
+                start_i, end_i = mid_frame - N_FRAME/2, mid_frame + N_FRAME - N_FRAME/2
+                start_bin = start_i * pm.HOP_LENGTH
+                sub_audio = audio[start_bin: start_bin + N_BIN]
+                sub_mc = melody[start_i: end_i]
+                assert(len(sub_audio) == N_BIN)
+                assert(len(sub_mc) == N_FRAME)
+                sub_fn = audio_fn + '_' + str(mid_frame)
+                direction = pm.D_ASCENDING if seg.val >= 0 else pm.D_DESCENDING
+                cand_dict[direction].append((sub_audio, sub_mc, sub_fn, nt, seg, start_i, end_i))
+                # rosa.output.write_wav('trans/audio/clip_'+sub_fn+'.wav', sub_audio, sr=pm.SAMPLING_RATE, norm=False)
+    return cand_dict, cand_results
+
+def apply_predictions(notes, direction, cand_list, pred_list, cand_results, no_next):
+    ### Directions must be applied in the order of cand_dict since merging changes next_note
+    rate = float(pm.HOP_LENGTH) / float(pm.SAMPLING_RATE)
+    sign = 1 if direction == pm.D_ASCENDING else -1 
+    for pred, cand in zip(pred_list, cand_list):
+        sub_audio, sub_mc, sub_fn, nt, seg, start_i, end_i = cand
+        t_name = pm.inv_tech_dict[direction][np.argmax(pred)]
+        t_type = get_tech(t_name, direction)
+        origin_t_val = nt.tech_value(t_type)
+        t_val = int(round(seg.diff())) if t_type in (T_BEND, T_RELEASE) else origin_t_val + 1
+        if t_type < T_NORMAL:
+            ### Merge Notes
+            if nt.next_note is None:
+                print ('No next note. Ignore this candidate.')
+                no_next.append([start_i * rate, end_i * rate, t_type * sign])
+                continue
+                # print 'next_note is None'
+                # print nt, cand[4]
+                # if t_type in [T_HAMMER, T_PULL, T_SLIDE]:
+                #     print('WARNING!!! Changing {} to bend or release.'.format(t_type))
+                #     print cand[4]
+                #     t_type = T_BEND if direction == pm.D_ASCENDING else T_RELEASE
+            elif t_type in [T_BEND, T_RELEASE]:
+                notes.merge_next(nt, nt.next_note)
+            elif t_type in [T_HAMMER, T_PULL, T_SLIDE]:
+                tv = nt.next_note.tech_value(t_type)
+                nt.next_note.set_tech_value(t_type, tv+2)
+            nt.set_tech_value(t_type, t_val)
+        cand_results.append([start_i * rate, end_i * rate, t_type * sign])
+
+def write_results(notes, cand_results, no_next, save_dir, profiler=NULL_PROFILER):
+    profiler.count('final_notes', len(notes))
     # note.merge_notes(notes)
-    cont_notes = [nt.discrete_to_cont(pm.HOP_LENGTH, pm.SAMPLING_RATE) for nt in notes]
-    np.savetxt(save_dir+sep+'FinalNotes.txt', [n.array_repr() for n in cont_notes], fmt='%.8f')
-    return cont_notes
+    cont_arr = discrete_to_cont_array(notes, pm.HOP_LENGTH, pm.SAMPLING_RATE)
+    with profiler.timer('io'):
+        np.savetxt(save_dir+sep+'NoNextNote.txt', no_next, fmt='%.8f')
+        np.savetxt(save_dir+sep+'CandidateResults.txt', cand_results, fmt='%.8f')
+        np.savetxt(save_dir+sep+'FinalNotes.txt', cont_arr, fmt='%.8f')
+    return [Note(array=arr) for arr in cont_arr]
             
-def classification(model_fp, cand_list):
-    model = models.Model.init_from_file(model_fp)
-    data_list = [model.extract_features(*(cand[:3])) for cand in cand_list]
-    pred_list = model.run(data_list)
+def classification(model_fp, cand_list, profiler=NULL_PROFILER, audio=None, song_fmaps=None):
+    from guitar_trans import models
+    with profiler.timer('model_load'):
+        model = models.load_model(model_fp)
+    data_list = candidate_features(model, cand_list, profiler, audio, song_fmaps)
+    with profiler.timer('inference'):
+        pred_list = model.run(data_list)
     return pred_list   
 
+def candidate_features(model, cand_list, profiler=NULL_PROFILER, audio=None, song_fmaps=None):
+    with profiler.timer('feature_extraction'):
+        mcs = np.array([cand[1] for cand in cand_list])
+        fns = [cand[2] for cand in cand_list]
+        fmap = None
+        if song_fmaps is not None:
+            ### Compute the feature map of the whole song once and slice every candidate from it
+            key = model.song_feature_map.__func__
+            if key not in song_fmaps:
+                song_fmaps[key] = model.song_feature_map(audio)
+            fmap = song_fmaps[key]
+        if fmap is not None:
+            return model.extract_features_from_map(fmap, [cand[5] for cand in cand_list], mcs, fns)
+        clips = np.array([cand[0] for cand in cand_list])
+        return model.extract_features_batch(clips, mcs, fns)
+
 def get_tech(t_name, direction):
     if t_name == pm.BEND and direction == pm.D_ASCENDING:
         return T_BEND
@@ -112,26 +168,175 @@ def get_tech(t_name, direction):
     else:
         raise ValueError("t_name shouldn't be {}.".format(t_name))
 
-def main(audio_fp, asc_model_fp, desc_model_fp, output_dir, mc_fp=None, eval_note=None, eval_ts=None):
+def main(audio_fp, asc_model_fp, desc_model_fp, output_dir, mc_fp=None, eval_note=None, eval_ts=None, 
+         profile=False, song_features=False):
     audio_fn = path.splitext(path.basename(audio_fp))[0]
     save_dir = path.join(output_dir, audio_fn)
+    profiler = Profiler(audio_fn) if profile else NULL_PROFILER
+    with profiler.timer('total'):
+        audio, melody = load_song(audio_fp, save_dir, mc_fp, profiler)
+        notes = transcribe(audio, melody, asc_model_fp, desc_model_fp, save_dir, audio_fn, profiler, song_features)
+        evaluate_song(notes, save_dir, audio_fn, eval_note, eval_ts, profiler)
+    if profile:
+        profiler.save(save_dir+sep+'Profile.json')
+    return notes
+
+def load_song(audio_fp, save_dir, mc_fp=None, profiler=NULL_PROFILER):
+    ### Decode the audio and load (or extract with MELODIA) its melody contour
+    import librosa as rosa
     if mc_fp is None:
-        mc, mc_midi = extract_melody(audio_fp, save_dir)
+        with profiler.timer('melody_extraction'):
+            from melody_extraction import extract_melody
+            mc, mc_midi = extract_melody(audio_fp, save_dir)
     else:
-        mc_midi = np.loadtxt(mc_fp)
-    audio, sr = rosa.load(audio_fp, sr=None, mono=True)
-    melody = Contour(0, mc_midi)
-    notes = transcribe(audio, melody, asc_model_fp, desc_model_fp, save_dir, audio_fn)
+        with profiler.timer('io'):
+            mc_midi = np.loadtxt(mc_fp)
+    with profiler.timer('audio_load'):
+        audio, sr = rosa.load(audio_fp, sr=None, mono=True)
+    return audio, Contour(0, mc_midi)
+
+def evaluate_song(notes, save_dir, audio_fn, eval_note=None, eval_ts=None, profiler=NULL_PROFILER):
     if eval_note is not None:
-        sg = Song(name=audio_fn)
-        sg.load_esn_list(eval_note)
-        evaluation_note(sg.es_note_list, notes, save_dir, audio_fn, string='evaluate notes')
-        evaluation_esn(sg.es_note_list, notes, save_dir, audio_fn, string='evaluate esn')
+        with profiler.timer('evaluation'):
+            from guitar_trans.evaluation import evaluation_note, evaluation_esn
+            sg = Song(name=audio_fn)
+            sg.load_esn_list(eval_note)
+            evaluation_note(sg.es_note_list, notes, save_dir, audio_fn, string='evaluate notes')
+            evaluation_esn(sg.es_note_list, notes, save_dir, audio_fn, string='evaluate esn')
 
     if eval_ts is not None:
         ans_list = np.loadtxt(eval_ts)
         # TODO
 
+#=====BATCH TRANSCRIPTION=====#
+
+def collect_audio_files(audio_fp):
+    """
+    Get the audio files to transcribe from a single audio file, a directory
+    (all .wav files in it) or a text file listing one audio filepath per line.
+    """
+    if path.isdir(audio_fp):
+        return sorted(path.join(audio_fp, fn) for fn in listdir(audio_fp) if fn.endswith('.wav'))
+    elif path.splitext(audio_fp)[1] in ('.txt', '.list'):
+        with open(audio_fp) as f:
+            return [l.strip() for l in f if l.strip()]
+    return [audio_fp]
+
+def unique_songs(audio_fps):
+    """
+    audio_fps without repeated files, in order. Every song writes to
+    output_dir/<basename>, so songs with the same basename in different
+    directories are rejected rather than overwriting each other.
+    """
+    unique, seen, names = [], set(), {}
+    for fp in audio_fps:
+        real_fp = path.realpath(fp)
+        if real_fp in seen: continue
+        seen.add(real_fp)
+        unique.append(fp)
+        names.setdefault(path.splitext(path.basename(fp))[0], []).append(fp)
+    clashes = [fps for fps in names.values() if len(fps) > 1]
+    if clashes:
+        raise ValueError('Songs with the same name would share an output directory: {}'.format(
+                         '; '.join(', '.join(fps) for fps in clashes)))
+    if len(unique) < len(audio_fps):
+        print('Skipping {} repeated audio files.'.format(len(audio_fps) - len(unique)))
+    return unique
+
+def find_song_file(file_dir, audio_fp, ext):
+    ### The file of this song in file_dir (e.g. cv_1.esn.answer for cv_1.wav), if any
+    if file_dir is None: return None
+    fp = path.join(file_dir, path.splitext(path.basename(audio_fp))[0] + ext)
+    return fp if path.isfile(fp) else None
+
+### Options of the current worker process, set by _init_worker
+_worker_opts = {}
+
+def _init_worker(asc_model_fp, desc_model_fp, output_dir, profile, song_features):
+    ### Load and compile both models once; every song of this worker reuses them.
+    ### A failing initializer would make Pool respawn the worker forever, so a 
+    ### loading error is kept and reported by every job instead.
+    _worker_opts.update(asc_model_fp=asc_model_fp, desc_model_fp=desc_model_fp, output_dir=output_dir, 
+                        profile=profile, song_features=song_features, init_error=None)
+    try:
+        from guitar_trans import models
+        models.load_model(asc_model_fp)
+        models.load_model(desc_model_fp)
+    except Exception as e:
+        traceback.print_exc()
+        _worker_opts['init_error'] = repr(e)
+
+def _transcribe_job(job):
+    audio_fp, mc_fp, eval_note = job
+    opts = _worker_opts
+    start_time = time.time()
+    if opts['init_error'] is not None:
+        return audio_fp, 'failed', 0, 0.0, 'model loading failed: ' + opts['init_error']
+    try:
+        notes = main(audio_fp, opts['asc_model_fp'], opts['desc_model_fp'], opts['output_dir'], 
+                     mc_fp, eval_note, profile=opts['profile'], song_features=opts['song_features'])
+        return audio_fp, 'ok', len(notes), time.time() - start_time, ''
+    except Exception as e:
+        traceback.print_exc()
+        return audio_fp, 'failed', 0, time.time() - start_time, repr(e)
+
+def batch_main(audio_fps, asc_model_fp, desc_model_fp, output_dir, mc_dir=None, eval_dir=None, 
+               n_jobs=1, profile=False, song_features=False):
+    """
+    Transcribe many songs with n_jobs worker processes, each holding its own 
+    compiled models. Songs get their own output directories as with main(), 
+    and a summary of all songs is written to output_dir/BatchSummary.csv.
+
+    Parameters
+    ----------
+    audio_fps: list of str, the audio files
+    mc_dir: str, directory of <song>.MIDI.melody contours (extracted when missing)
+    eval_dir: str, directory of <song>.esn.answer files to evaluate against
+
+    Returns
+    -------
+    results: list of (audio_fp, status, n_notes, seconds, error), in the order of audio_fps
+    """
+    audio_fps = unique_songs(audio_fps)
+    for fp in (asc_model_fp, desc_model_fp):
+        if not path.isfile(fp):
+            raise IOError('Model file {} not found.'.format(fp))
+    jobs = [(fp, find_song_file(mc_dir, fp, '.MIDI.melody'), find_song_file(eval_dir, fp, '.esn.answer')) 
+            for fp in audio_fps]
+    init_args = (asc_model_fp, desc_model_fp, output_dir, profile, song_features)
+    print('Transcribing {} songs with {} workers...'.format(len(jobs), n_jobs))
+    start_time = time.time()
+    results = []
+    if n_jobs > 1:
+        pool = Pool(n_jobs, initializer=_init_worker, initargs=init_args)
+        res_iter = pool.imap_unordered(_transcribe_job, jobs)
+    else:
+        pool = None
+        _init_worker(*init_args)
+        res_iter = (_transcribe_job(job) for job in jobs)
+    for res in res_iter:
+        results.append(res)
+        print('[{}/{}] {} {} ({:.1f} s)'.format(len(results), len(jobs), res[1], res[0], res[3]))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return write_batch_summary(results, audio_fps, output_dir, start_time)
+
+def write_batch_summary(results, audio_fps, output_dir, start_time):
+    ### Sort results in the order of audio_fps and write them to output_dir/BatchSummary.csv
+    order = dict((fp, i) for i, fp in enumerate(audio_fps))
+    results.sort(key=lambda r: order[r[0]])
+
+    if not path.exists(output_dir): makedirs(output_dir)
+    with open(path.join(output_dir, 'BatchSummary.csv'), 'w') as f:
+        w = csv.writer(f, delimiter=',')
+        w.writerow(['audio_fp', 'status', 'n_notes', 'seconds', 'error'])
+        for res in results:
+            w.writerow([res[0], res[1], res[2], '{:.3f}'.format(res[3]), res[4]])
+    n_failed = len([r for r in results if r[1] != 'ok'])
+    print('Transcribed {} songs in {:.1f} s, {} failed.'.format(len(results), time.time() - start_time, n_failed))
+    return results
+
 def parser():
     import argparse
     p = argparse.ArgumentParser(
@@ -143,7 +348,8 @@ Script for transcribing a song.
 ===================================================================
     """)
     p.add_argument('audio_fp', type=str, metavar='audio_fp',
-                    help='The filepath of the audio to be transcribed.')
+                    help='The filepath of the audio to be transcribed, or a directory of .wav files ' \
+                         'or a .txt file listing audio filepaths to transcribe in batch.')
     p.add_argument('-a', '--asc_model_fp', type=str, metavar='asc_model_fp', default='models/cnn_normmc/ascending.npz',
                     help='The name of the ascending model.')
     p.add_argument('-d', '--desc_model_fp', type=str, metavar='desc_model_fp', default='models/cnn_normmc/descending.npz',
@@ -151,13 +357,42 @@ Script for transcribing a song.
     p.add_argument('-o', '--output_dir', type=str, metavar='output_dir', default='outputs',
                     help='The output directory.')
     p.add_argument('-m', '--melody_contour', type=str, default=None, 
-                    help='The filepath of melody contour.')
+                    help='The filepath of melody contour. In batch mode, the directory of <song>.MIDI.melody files.')
     p.add_argument('-e', '--evaluate', type=str, default=None, 
-                    help='The filepath of answer file.')
+                    help='The filepath of answer file. In batch mode, the directory of <song>.esn.answer files.')
+    p.add_argument('-j', '--jobs', type=int, default=1,
+                    help='The number of worker processes in batch mode.')
+    p.add_argument('--pipeline', action='store_true',
+                    help='In batch mode, prepare songs in -j worker processes while the models of ' \
+                         'the main process classify the previous ones, instead of -j full worker processes.')
+    p.add_argument('-p', '--profile', action='store_true',
+                    help='Write the time spent in each stage to Profile.json in the output directory.')
+    p.add_argument('-s', '--song_features', action='store_true',
+                    help='Compute the spectral features of the whole song once and slice candidates from them.')
     return p.parse_args()
 
 if __name__ == '__main__':
     args = parser()
-    main(args.audio_fp, args.asc_model_fp, args.desc_model_fp, 
-         args.output_dir, args.melody_contour, args.evaluate)
-
+    audio_fps = collect_audio_files(args.audio_fp)
+    if audio_fps == [args.audio_fp]:
+        main(args.audio_fp, args.asc_model_fp, args.desc_model_fp, 
+             args.output_dir, args.melody_contour, args.evaluate, 
+             profile=args.profile, song_features=args.song_features)
+    else:
+        ### In batch mode -m and -e name directories of per-song files
+        for opt, val in (('-m', args.melody_contour), ('-e', args.evaluate)):
+            if val is not None and not path.isdir(val):
+                sys.exit('ERROR: in batch mode {} must be a directory, not {}.'.format(opt, val))
+        try:
+            audio_fps = unique_songs(audio_fps)
+        except ValueError as e:
+            sys.exit('ERROR: {}'.format(e))
+        if args.pipeline:
+            from pipeline import pipeline_main
+            pipeline_main(audio_fps, args.asc_model_fp, args.desc_model_fp, args.output_dir, 
+                          args.melody_contour, args.evaluate, n_workers=args.jobs, 
+                          profile=args.profile, song_features=args.song_features)
+        else:
+            batch_main(audio_fps, args.asc_model_fp, args.desc_model_fp, args.output_dir, 
+                       args.melody_contour, args.evaluate, n_jobs=args.jobs, 
+                       profile=args.profile, song_features=args.song_features)
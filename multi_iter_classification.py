@@ -4,7 +4,8 @@ import classification as clf
 import numpy as np
 import sys, os
 
-def main(model_name, model_type, model_opts, data_dir, iteration, sep_direction=True, test_aug=False, description=None):
+def main(model_name, model_type, model_opts, data_dir, iteration, sep_direction=True, test_aug=False, description=None,
+         n_jobs=1, store_dir=None):
     results = {}
     for key in [pm.D_ASCENDING, pm.D_DESCENDING]:
         results[key] = np.zeros((pm.NUM_CLASS, pm.NUM_CLASS), dtype=int)
@@ -22,9 +23,7 @@ def main(model_name, model_type, model_opts, data_dir, iteration, sep_direction=
     if not os.path.isdir(clf.output_dir):
         os.mkdir(clf.output_dir)
     ### load and pre-process input features
-    feature_bank = clf.load_n_preprocess_input_feature(audio_dir, mc_dir, model_class, sep_direction)
-    # np.save('feature_bank_spec+mc.npy', feature_bank)
-    # feature_bank = np.load('feature_bank_mfcc.npy').item()
+    feature_bank = clf.load_feature_bank(audio_dir, mc_dir, model_class, sep_direction, store_dir, n_jobs)
     print('Run {} iterations.'.format(iteration))
     for i in range(iteration):
         print('iteration: {}'.format(i))
@@ -61,10 +60,15 @@ Script for training guitar playing technique classification models for several r
                     help='The description of this model.')
     p.add_argument('-i', '--iteration', type=int, default=10,
                     help='The description of this model.')
+    p.add_argument('-j', '--jobs', type=int, default=1,
+                    help='The number of worker processes loading the dataset.')
+    p.add_argument('-s', '--store_dir', type=str, default=None,
+                    help='The feature store directory. Defaults to <data_dir>/features/<feature class>.')
 
     return p.parse_args()
 
 if __name__ == '__main__':
     args = parser()
-    main(args.model_name, args.model_type, args.model_opts, args.data_dir, args.iteration, description=args.description)
+    main(args.model_name, args.model_type, args.model_opts, args.data_dir, args.iteration, description=args.description,
+         n_jobs=args.jobs, store_dir=args.store_dir)
 
@@ -0,0 +1,253 @@
+"""
+--------------------------------------------------------------------------------
+Staged transcription pipeline for batches of songs.
+--------------------------------------------------------------------------------
+main.main() runs every stage of a song one after another. Here the stages
+are connected by bounded queues, so while one song is in inference the next
+ones are already being prepared and the previous one is being written:
+
+    prepare -> inference -> write
+
+    prepare:    audio decoding, melody contour (loaded or MELODIA), TENT note
+                tracking, candidate extraction and candidate features
+    inference:  both classifiers and applying their predictions to the notes
+    write:      result files, evaluation and profile
+
+Preparing a song is CPU-bound Python and numpy work, so it runs in a pool of
+worker processes (threads would only take turns on the GIL); the prepare
+stage's threads just wait for them. The models are loaded once in the main
+process and shared by all songs for inference. Every song still gets its own
+output directory, and BatchSummary.csv is written as with main.batch_main().
+--------------------------------------------------------------------------------
+"""
+import threading, time, traceback, Queue
+import guitar_trans.parameters as pm
+from guitar_trans import models
+from guitar_trans.note import NoteSequence
+from guitar_trans.profiling import Profiler, NULL_PROFILER
+from multiprocessing import Pool
+from os import path, sep
+import main as trans
+
+### End-of-stream marker passed down the queues
+_STOP = object()
+
+class SongJob(object):
+    """
+    The state of one song while it moves through the pipeline.
+    """
+    def __init__(self, audio_fp, output_dir, mc_fp=None, eval_note=None, profile=False):
+        self.audio_fp = audio_fp
+        self.audio_fn = path.splitext(path.basename(audio_fp))[0]
+        self.save_dir = path.join(output_dir, self.audio_fn)
+        self.mc_fp = mc_fp
+        self.eval_note = eval_note
+        self.profiler = Profiler(self.audio_fn) if profile else NULL_PROFILER
+        self.start_time = time.time()
+        self.notes = None
+        self.cand_dict = None
+        self.cand_results = None
+        self.data_dict = None
+        self.no_next = []
+        self.final_notes = []
+        self.error = None
+
+    def result(self):
+        ### Same row as main._transcribe_job
+        status = 'ok' if self.error is None else 'failed'
+        return (self.audio_fp, status, len(self.final_notes), time.time() - self.start_time,
+                self.error or '')
+
+class Stage(object):
+    """
+    n_workers threads applying fn to the jobs of in_q and passing them to
+    out_q. For CPU-bound work, fn should hand the job to worker processes. A job that failed in an earlier stage is passed on untouched.
+    """
+    def __init__(self, name, fn, in_q, out_q, n_workers=1):
+        self.name = name
+        self.fn = fn
+        self.in_q = in_q
+        self.out_q = out_q
+        self.n_alive = n_workers
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._work, name='{}-{}'.format(name, i))
+                        for i in range(n_workers)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def _work(self):
+        while True:
+            job = self.in_q.get()
+            if job is _STOP:
+                ### Leave the marker for the other workers; the last one forwards it
+                self.in_q.put(_STOP)
+                with self.lock:
+                    self.n_alive -= 1
+                    last = self.n_alive == 0
+                if last:
+                    self.out_q.put(_STOP)
+                return
+            if job.error is None:
+                try:
+                    self.fn(job)
+                except Exception as e:
+                    traceback.print_exc()
+                    job.error = '{}: {!r}'.format(self.name, e)
+            self.out_q.put(job)
+
+#=====PREPARATION (WORKER PROCESSES)=====#
+
+def pack_notes(notes, cand_dict):
+    """
+    Notes linked by next_note form chains as long as the song, too deep to 
+    pickle, so the links are sent as indices into one list of all notes.
+    Only used in the worker, which drops its notes afterwards.
+    """
+    all_notes, index = [], {}
+    def add(nt):
+        while nt is not None and id(nt) not in index:
+            index[id(nt)] = len(all_notes)
+            all_notes.append(nt)
+            nt = getattr(nt, 'next_note', None)
+    for nt in notes:
+        add(nt)
+    for cand_list in cand_dict.values():
+        for cand in cand_list:
+            add(cand[3])
+    links = []
+    for nt in all_notes:
+        nxt = getattr(nt, 'next_note', None)
+        links.append(-1 if nxt is None else index[id(nxt)])
+        if nxt is not None: nt.next_note = None
+    seq = [index[id(nt)] for nt in notes]
+    ### The clips are not needed anymore
+    cands = dict((d, [(None, c[1], c[2], index[id(c[3])], c[4], c[5], c[6]) for c in cand_list])
+                 for d, cand_list in cand_dict.items())
+    return all_notes, links, seq, cands
+
+def unpack_notes(all_notes, links, seq, cands):
+    for nt, i in zip(all_notes, links):
+        if i >= 0: nt.next_note = all_notes[i]
+    notes = NoteSequence([all_notes[i] for i in seq])
+    cand_dict = dict((d, [c[:3] + (all_notes[c[3]],) + c[4:] for c in cand_list])
+                     for d, cand_list in cands.items())
+    return notes, cand_dict
+
+def _prepare_song(args):
+    audio_fp, save_dir, audio_fn, mc_fp, feature_classes, song_features, profile = args
+    profiler = Profiler(audio_fn) if profile else NULL_PROFILER
+    try:
+        audio, melody = trans.load_song(audio_fp, save_dir, mc_fp, profiler)
+        notes = trans.track_notes(melody, save_dir, profiler)
+        cand_dict, cand_results = trans.extract_candidates(notes, audio, melody, audio_fn, profiler)
+        ### Features only need the (class) methods of the Feature classes, not compiled models
+        song_fmaps = {} if song_features else None
+        data_dict = {}
+        for direction, cand_list in cand_dict.items():
+            profiler.count('candidates.' + direction, len(cand_list))
+            if len(cand_list) > 0:
+                data_dict[direction] = trans.candidate_features(
+                    getattr(models, feature_classes[direction]), cand_list, profiler, audio, song_fmaps)
+        return pack_notes(notes, cand_dict), cand_results, data_dict, profiler.to_dict()
+    except Exception:
+        traceback.print_exc()
+        raise
+
+class TranscriptionPipeline(object):
+    def __init__(self, asc_model_fp, desc_model_fp, song_features=False,
+                 n_prepare=2, queue_size=4):
+        self.model_fps = {pm.D_ASCENDING: asc_model_fp, pm.D_DESCENDING: desc_model_fp}
+        self.song_features = song_features
+        self.n_workers = [n_prepare, 1, 1]
+        self.queue_size = queue_size
+        ### Fork the workers before the models are compiled in this process
+        self.pool = Pool(n_prepare)
+        print('Loading models...')
+        self.models = dict((d, models.load_model(fp)) for d, fp in self.model_fps.items())
+        self.feature_classes = dict((d, type(m).__name__) for d, m in self.models.items())
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    #=====STAGES=====#
+
+    def prepare(self, job):
+        ### Blocks this stage thread (not the GIL) until a worker process has prepared the song
+        packed, job.cand_results, job.data_dict, profile = self.pool.apply(_prepare_song, ((
+            job.audio_fp, job.save_dir, job.audio_fn, job.mc_fp, self.feature_classes,
+            self.song_features, job.profiler is not NULL_PROFILER),))
+        job.notes, job.cand_dict = unpack_notes(*packed)
+        job.profiler.merge(profile)
+
+    def inference(self, job):
+        with job.profiler.timer('inference'):
+            pred_dict = dict((d, self.models[d].run(data_list)) for d, data_list in job.data_dict.items())
+        ### Same direction order as main.transcribe, since applying predictions merges notes
+        for direction in job.cand_dict:
+            if direction not in pred_dict: continue
+            pred_list = pred_dict[direction]
+            trans.apply_predictions(job.notes, direction, job.cand_dict[direction], pred_list,
+                                    job.cand_results, job.no_next)
+        job.data_dict = None
+
+    def write(self, job):
+        job.final_notes = trans.write_results(job.notes, job.cand_results, job.no_next,
+                                              job.save_dir, job.profiler)
+        trans.evaluate_song(job.final_notes, job.save_dir, job.audio_fn, job.eval_note,
+                            profiler=job.profiler)
+        job.cand_dict = None
+        job.notes = None
+
+    #=====RUN=====#
+
+    def run(self, jobs):
+        """
+        Push jobs through the pipeline and yield them as they are written,
+        which is not necessarily the order of jobs.
+        """
+        fns = [self.prepare, self.inference, self.write]
+        names = ['prepare', 'inference', 'write']
+        queues = [Queue.Queue(maxsize=self.queue_size) for _ in range(len(fns) + 1)]
+        stages = [Stage(name, fn, queues[i], queues[i+1], n)
+                  for i, (name, fn, n) in enumerate(zip(names, fns, self.n_workers))]
+        feeder = threading.Thread(target=self._feed, args=(jobs, queues[0]))
+        feeder.daemon = True
+        feeder.start()
+        while True:
+            job = queues[-1].get()
+            if job is _STOP: break
+            if job.profiler is not NULL_PROFILER and path.isdir(job.save_dir):
+                job.profiler.add_time('total', time.time() - job.start_time)
+                job.profiler.save(job.save_dir+sep+'Profile.json')
+            yield job
+
+    def _feed(self, jobs, in_q):
+        for job in jobs:
+            ### Start the clock when the song enters the pipeline, not when it is created
+            job.start_time = time.time()
+            in_q.put(job)
+        in_q.put(_STOP)
+
+def pipeline_main(audio_fps, asc_model_fp, desc_model_fp, output_dir, mc_dir=None, eval_dir=None,
+                  n_workers=2, queue_size=4, profile=False, song_features=False):
+    """
+    Transcribe many songs with the staged pipeline. Songs are prepared by
+    n_workers worker processes; inference and writing run in this process.
+    Returns the same results as main.batch_main().
+    """
+    audio_fps = trans.unique_songs(audio_fps)
+    jobs = [SongJob(fp, output_dir, trans.find_song_file(mc_dir, fp, '.MIDI.melody'),
+                    trans.find_song_file(eval_dir, fp, '.esn.answer'), profile)
+            for fp in audio_fps]
+    pipe = TranscriptionPipeline(asc_model_fp, desc_model_fp, song_features, n_workers, queue_size)
+    print('Transcribing {} songs with the staged pipeline...'.format(len(jobs)))
+    start_time = time.time()
+    results = []
+    for job in pipe.run(jobs):
+        res = job.result()
+        results.append(res)
+        print('[{}/{}] {} {} ({:.1f} s)'.format(len(results), len(jobs), res[1], res[0], res[3]))
+    pipe.close()
+    return trans.write_batch_summary(results, audio_fps, output_dir, start_time)
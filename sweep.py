@@ -0,0 +1,274 @@
+"""
+--------------------------------------------------------------------------------
+Script for sweeping the network options of a classification model.
+--------------------------------------------------------------------------------
+A sweep takes one of the option dicts of parameters.py and overrides some of
+its entries in every trial. The trials are given by a JSON spec:
+
+    {
+        "model_type": "MFCCCNNModel",
+        "model_opts": "cnn_opts",
+        "grid": {"dropout_p": [0.3, 0.5], "conv_1.num_filters": [128, 256]},
+        "random": {"n_trials": 4, "seed": 0,
+                   "space": {"layer_list": [[1800, 900], [900, 450]]}},
+        "folds": [0, 1],
+        "num_epochs": 60,
+        "balance": "balanced"
+    }
+
+"grid" gives every combination of its values; "random" draws n_trials
+combinations of the values in "space". Keys with dots address nested dicts
+(e.g. 'conv_1.num_filters'). Every trial trains and tests the given folds of
+every direction (all folds by default), with the optional per-epoch class
+balancing of Model.train ("balance"), in a worker process, with at most
+n_jobs at a time, on the features of the feature store.
+
+Results are appended to <output_dir>/<sweep>/results.csv, one row per trial
+and direction, with the accuracy, weighted F1, training time and inference
+latency per clip. A trial is identified by a hash of its overrides and of
+the base settings it runs with (model type and options, folds, epochs,
+balancing, direction mode and augmentation). Running the same sweep again skips the trials
+that are already in the table, so an interrupted sweep is resumed, while a
+changed base setting runs every trial again.
+
+Example:
+    $ python sweep.py cnn_sweep sweep_spec.json data -j 4
+--------------------------------------------------------------------------------
+"""
+import os, sys, csv, copy, hashlib, itertools, json, random, subprocess, time
+import numpy as np
+from guitar_trans import parameters as pm
+from cv_scheduler import worker_env
+
+RESULT_COLUMNS = ['trial', 'overrides', 'direction', 'status', 'accuracy', 'f1',
+                  'train_secs', 'latency_ms']
+
+#=====TRIALS=====#
+
+### Fields of a spec that every trial runs with, besides its overrides
+BASE_FIELDS = ['model_type', 'model_opts', 'folds', 'num_epochs', 'balance']
+
+def base_settings(spec, sep_direction=True, n_aug=0, aug_seed=0):
+    base = dict((k, spec.get(k)) for k in BASE_FIELDS)
+    base['num_epochs'] = spec.get('num_epochs', 100)
+    base['sep_direction'] = bool(sep_direction)
+    base['augment'] = {'n_aug': n_aug, 'seed': aug_seed} if n_aug > 0 else None
+    return base
+
+def trial_id(overrides, base):
+    return hashlib.sha1(json.dumps([base, overrides], sort_keys=True)).hexdigest()[:10]
+
+def expand_spec(spec, sep_direction=True, n_aug=0, aug_seed=0):
+    """
+    Returns
+    -------
+    trials: list of (trial_id, overrides), grid trials first, without duplicates
+    """
+    combos = []
+    grid = spec.get('grid', {})
+    keys = sorted(grid)
+    for values in itertools.product(*[grid[k] for k in keys]):
+        combos.append(dict(zip(keys, values)))
+    if 'random' in spec:
+        rnd = spec['random']
+        rng = random.Random(rnd.get('seed', 0))
+        space = rnd['space']
+        for _ in range(rnd['n_trials']):
+            combos.append(dict((k, rng.choice(space[k])) for k in sorted(space)))
+    base = base_settings(spec, sep_direction, n_aug, aug_seed)
+    trials, seen = [], set()
+    for overrides in combos:
+        tid = trial_id(overrides, base)
+        if tid not in seen:
+            seen.add(tid)
+            trials.append((tid, overrides))
+    return trials
+
+def apply_overrides(net_opts, overrides):
+    net_opts = copy.deepcopy(net_opts)
+    for key, value in overrides.items():
+        d = net_opts
+        path = key.split('.')
+        for k in path[:-1]:
+            d = d[k]
+        d[path[-1]] = value
+    return net_opts
+
+#=====RESULTS=====#
+
+def read_results(results_fp):
+    if not os.path.isfile(results_fp):
+        return []
+    with open(results_fp) as f:
+        return list(csv.DictReader(f))
+
+def append_results(results_fp, rows):
+    new_file = not os.path.isfile(results_fp)
+    with open(results_fp, 'a') as f:
+        w = csv.writer(f, delimiter=',')
+        if new_file:
+            w.writerow(RESULT_COLUMNS)
+        for row in rows:
+            w.writerow([row[c] for c in RESULT_COLUMNS])
+
+#=====WORKER=====#
+
+def run_trial(args):
+    ### Runs in the worker process: train the folds of one trial and save its results as JSON
+    import classification as clf
+    from guitar_trans import models
+    from guitar_trans.dataset import Dataset
+    from guitar_trans.feature_store import FeatureStore
+    with open(args.trial_fp) as f:
+        trial = json.load(f)
+    clf.model_dir, clf.output_dir = trial['model_dir'], trial['output_dir']
+    model_class = getattr(models, trial['model_type'])
+    net_opts = apply_overrides(getattr(pm, trial['model_opts']), trial['overrides'])
+    feature_bank = FeatureStore(trial['store_dir']).load()
+    model_name = trial['trial']
+    clf.prepare_dirs(model_name)
+    results = {}
+    for direction in sorted(feature_bank):
+        bank = feature_bank[direction]
+        direction_type = direction if trial['sep_direction'] else pm.D_MIXED
+        folds = trial['folds'] if trial['folds'] is not None else range(len(bank))
+        cm_all = np.zeros((pm.NUM_CLASS, pm.NUM_CLASS), dtype=int)
+        train_secs, latencies = 0.0, []
+        for idx in folds:
+            start_time = time.time()
+            cm_all += clf.train_fold(bank, idx, model_name, model_class, net_opts, direction_type,
+                                     num_epochs=trial['num_epochs'], balance=trial.get('balance'))
+            train_secs += time.time() - start_time
+            ### Inference latency of the trained model on (up to 256) clips of the test fold,
+            ### without augmented copies as in train_fold
+            model_fp = os.path.join(clf.model_dir, model_name,
+                                    model_name+'_'+str(idx)+'.'+direction_type+'.npz')
+            model = models.load_model(model_fp)
+            test_list = Dataset.from_folds([bank[idx]])
+            origin_idx = [i for i, fn in enumerate(test_list.fns()) if 'aug' not in fn][:256]
+            feats = [feat[:-2] + (feat[-1],) for feat in test_list.subset(origin_idx)]
+            if len(feats) > 0:
+                start_time = time.time()
+                model.run(feats)
+                latencies.append((time.time() - start_time) * 1000.0 / len(feats))
+            models.clear_model_registry()
+        scores = clf.eval_scores(cm_all, direction, print_scores=True)
+        results[direction] = {
+            'accuracy': float(np.sum(np.diagonal(cm_all))) / max(1, np.sum(cm_all)),
+            'f1': float(scores[-1][3]),
+            'train_secs': train_secs,
+            'latency_ms': float(np.mean(latencies)) if latencies else float('nan')}
+    with open(args.result_fp, 'w') as f:
+        json.dump(results, f)
+
+#=====SCHEDULER=====#
+
+def main(sweep_name, spec_fp, data_dir, n_jobs=2, store_dir=None, sep_direction=True, load_jobs=1, 
+         n_aug=0, aug_seed=0):
+    import classification as clf
+    from guitar_trans import models
+    from guitar_trans.feature_store import feature_class_name
+    if n_jobs < 1:
+        raise ValueError('n_jobs must be at least 1, not {}.'.format(n_jobs))
+    with open(spec_fp) as f:
+        spec = json.load(f)
+    model_class = getattr(models, spec['model_type'])
+    if store_dir is None:
+        store_dir = os.path.join(data_dir, 'features', feature_class_name(model_class))
+    ### Build the feature store once, with the same augmentation as the runs sharing it; 
+    ### every trial memory-maps it
+    clf.load_feature_bank(os.path.join(data_dir, 'audio'), os.path.join(data_dir, 'melody'),
+                          model_class, sep_direction, store_dir, load_jobs, n_aug, aug_seed)
+
+    sweep_dir = os.path.join(clf.output_dir, sweep_name)
+    for d in ('trials', 'logs', 'theano'):
+        if not os.path.isdir(os.path.join(sweep_dir, d)):
+            os.makedirs(os.path.join(sweep_dir, d))
+    results_fp = os.path.join(sweep_dir, 'results.csv')
+    base = base_settings(spec, sep_direction, n_aug, aug_seed)
+    done = set(row['trial'] for row in read_results(results_fp))
+    trials = [t for t in expand_spec(spec, sep_direction, n_aug, aug_seed) if t[0] not in done]
+    print('{} trials to run, {} already done.'.format(len(trials), len(done)))
+
+    running = {}
+    free_slots = range(n_jobs)
+    start_time = time.time()
+    while trials or running:
+        while trials and free_slots:
+            tid, overrides = trials.pop(0)
+            slot = free_slots.pop(0)
+            trial_fp = os.path.join(sweep_dir, 'trials', tid + '.json')
+            result_fp = os.path.join(sweep_dir, 'trials', tid + '.result.json')
+            with open(trial_fp, 'w') as f:
+                json.dump(dict(base, trial=tid, overrides=overrides, store_dir=store_dir,
+                               model_dir=os.path.join(clf.model_dir, sweep_name), output_dir=sweep_dir),
+                          f, indent=2)
+            cmd = [sys.executable, os.path.abspath(__file__), 'worker', trial_fp, result_fp]
+            log = open(os.path.join(sweep_dir, 'logs', tid + '.log'), 'w')
+            proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT,
+                                    env=worker_env(os.path.join(sweep_dir, 'theano'), slot))
+            running[proc] = (tid, overrides, slot, log, result_fp)
+        time.sleep(1.0)
+        for proc in [p for p in running if p.poll() is not None]:
+            tid, overrides, slot, log, result_fp = running.pop(proc)
+            log.close()
+            free_slots.append(slot)
+            if proc.returncode != 0 or not os.path.isfile(result_fp):
+                ### Failed trials are not recorded, so they are run again on resume
+                print('Trial {} {} FAILED (see {})'.format(tid, json.dumps(overrides), log.name))
+                continue
+            with open(result_fp) as f:
+                results = json.load(f)
+            rows = []
+            for direction in sorted(results):
+                res = results[direction]
+                rows.append({'trial': tid, 'overrides': json.dumps(overrides, sort_keys=True),
+                             'direction': direction, 'status': 'ok',
+                             'accuracy': '{:.4f}'.format(res['accuracy']), 'f1': '{:.4f}'.format(res['f1']),
+                             'train_secs': '{:.1f}'.format(res['train_secs']),
+                             'latency_ms': '{:.3f}'.format(res['latency_ms'])})
+                print('Trial {} {} {}: accuracy {:.4f}, F1 {:.4f}'.format(
+                    tid, json.dumps(overrides), direction, res['accuracy'], res['f1']))
+            append_results(results_fp, rows)
+            sys.stdout.flush()
+    print('Sweep finished in {:.0f} s. Results in {}'.format(time.time() - start_time, results_fp))
+
+def parser():
+    import argparse
+    p = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=
+    """
+===================================================================
+Script for sweeping the network options of a classification model.
+===================================================================
+    """)
+    p.add_argument('sweep_name', type=str, metavar='sweep_name',
+                    help='The name of this sweep.')
+    p.add_argument('spec_fp', type=str, metavar='spec_fp',
+                    help='The JSON file describing the trials of the sweep.')
+    p.add_argument('data_dir', type=str, metavar='data_dir',
+                    help='The directory of the dataset to be used.')
+    p.add_argument('-j', '--jobs', type=int, default=2,
+                    help='The maximum number of trials run at the same time.')
+    p.add_argument('-s', '--store_dir', type=str, default=None,
+                    help='The feature store directory. Defaults to <data_dir>/features/<feature class>.')
+    p.add_argument('-l', '--load_jobs', type=int, default=1,
+                    help='The number of worker processes building the feature store.')
+    p.add_argument('-a', '--augment', type=int, default=0,
+                    help='The number of augmented copies of every clip in the feature store.')
+    p.add_argument('--aug_seed', type=int, default=0,
+                    help='The seed of the augmentations.')
+    args = p.parse_args()
+    if args.jobs < 1:
+        p.error('--jobs must be at least 1.')
+    return args
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == 'worker':
+        import argparse
+        run_trial(argparse.Namespace(trial_fp=sys.argv[2], result_fp=sys.argv[3]))
+    else:
+        args = parser()
+        main(args.sweep_name, args.spec_fp, args.data_dir, args.jobs, args.store_dir, load_jobs=args.load_jobs,
+             n_aug=args.augment, aug_seed=args.aug_seed)
@@ -0,0 +1,175 @@
+"""
+--------------------------------------------------------------------------------
+Resident transcription service: keeps the models compiled in one process and
+serves main.transcribe over a local HTTP port or Unix socket.
+--------------------------------------------------------------------------------
+Requests:
+    POST /transcribe    JSON body
+        {
+            "audio_fp":         audio file to transcribe (required),
+            "melody_contour":   precomputed MIDI melody contour file (optional,
+                                extracted with MELODIA if missing),
+            "output_dir":       output directory (optional, server default),
+            "song_features":    slice features from a whole-song map (optional)
+        }
+        Returns {"audio_fp", "seconds", "columns", "notes"}, where every note
+        is a row of FinalNotes.txt. Returns 503 when the queue is full.
+    GET /health         Returns the number of queued requests.
+
+Example:
+    $ python transcription_server.py --port 8123 &
+    $ curl -d '{"audio_fp": "lick_29.wav"}' http://localhost:8123/transcribe
+--------------------------------------------------------------------------------
+"""
+import json, os, threading, time, traceback
+import BaseHTTPServer, SocketServer, Queue
+from guitar_trans import models
+import main as transcription
+
+NOTE_COLUMNS = ['pitch', 'onset', 'duration', 'pre-bend', 'bend', 'release', 'pull',
+                'hammer', 'slide', 'slide-in', 'slide-out', 'vibrato']
+
+class TranscriptionJob(object):
+    def __init__(self, request):
+        self.request = request
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class TranscriptionService(object):
+    """
+    A bounded queue of transcription requests served by n_workers threads
+    that share the preloaded models.
+    """
+    def __init__(self, asc_model_fp, desc_model_fp, output_dir, n_workers=1, max_queue=16):
+        self.asc_model_fp = asc_model_fp
+        self.desc_model_fp = desc_model_fp
+        self.output_dir = output_dir
+        print('Loading models...')
+        models.load_model(asc_model_fp)
+        models.load_model(desc_model_fp)
+        self.queue = Queue.Queue(maxsize=max_queue)
+        self.workers = [threading.Thread(target=self._work) for _ in range(n_workers)]
+        for w in self.workers:
+            w.daemon = True
+            w.start()
+
+    def submit(self, request):
+        ### Raises Queue.Full if too many requests are waiting
+        if not isinstance(request, dict) or 'audio_fp' not in request:
+            raise ValueError('Missing audio_fp in request.')
+        job = TranscriptionJob(request)
+        self.queue.put_nowait(job)
+        return job
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                job.result = self.transcribe(job.request)
+            except Exception as e:
+                traceback.print_exc()
+                job.error = repr(e)
+            job.done.set()
+            self.queue.task_done()
+
+    def transcribe(self, request):
+        start_time = time.time()
+        notes = transcription.main(request['audio_fp'], self.asc_model_fp, self.desc_model_fp,
+                                   request.get('output_dir', self.output_dir),
+                                   request.get('melody_contour'),
+                                   song_features=request.get('song_features', False))
+        return {'audio_fp': request['audio_fp'],
+                'seconds': time.time() - start_time,
+                'columns': NOTE_COLUMNS,
+                'notes': [nt.array_repr().tolist() for nt in notes]}
+
+class TranscriptionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def send_json(self, code, data):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self.send_json(404, {'error': 'Unknown path {}.'.format(self.path)})
+        self.send_json(200, {'status': 'ok', 'queued': self.server.service.queue.qsize()})
+
+    def do_POST(self):
+        if self.path != '/transcribe':
+            return self.send_json(404, {'error': 'Unknown path {}.'.format(self.path)})
+        try:
+            length = int(self.headers.getheader('Content-Length', 0))
+            job = self.server.service.submit(json.loads(self.rfile.read(length)))
+        except Queue.Full:
+            return self.send_json(503, {'error': 'Too many queued requests.'})
+        except ValueError as e:
+            return self.send_json(400, {'error': str(e)})
+        job.done.wait()
+        if job.error is not None:
+            return self.send_json(500, {'error': job.error})
+        self.send_json(200, job.result)
+
+    def address_string(self):
+        ### Unix socket clients have no (host, port) address
+        return self.client_address[0] if self.client_address else 'unix'
+
+class TranscriptionHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class UnixTranscriptionServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+def serve(service, host='127.0.0.1', port=8123, socket_fp=None):
+    if socket_fp is not None:
+        if os.path.exists(socket_fp): os.remove(socket_fp)
+        server = UnixTranscriptionServer(socket_fp, TranscriptionHandler)
+        print('Serving on unix socket {}'.format(socket_fp))
+    else:
+        server = TranscriptionHTTPServer((host, port), TranscriptionHandler)
+        print('Serving on http://{}:{}'.format(host, port))
+    server.service = service
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_fp is not None and os.path.exists(socket_fp): os.remove(socket_fp)
+
+def parser():
+    import argparse
+    p = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=
+    """
+===================================================================
+Server keeping the transcription models warm between requests.
+===================================================================
+    """)
+    p.add_argument('-a', '--asc_model_fp', type=str, metavar='asc_model_fp', default='models/cnn_normmc/ascending.npz',
+                    help='The name of the ascending model.')
+    p.add_argument('-d', '--desc_model_fp', type=str, metavar='desc_model_fp', default='models/cnn_normmc/descending.npz',
+                    help='The name of the descending model.')
+    p.add_argument('-o', '--output_dir', type=str, metavar='output_dir', default='outputs',
+                    help='The default output directory.')
+    p.add_argument('--host', type=str, default='127.0.0.1',
+                    help='The host to listen on.')
+    p.add_argument('--port', type=int, default=8123,
+                    help='The port to listen on.')
+    p.add_argument('--socket', type=str, default=None,
+                    help='Listen on this Unix socket instead of a TCP port.')
+    p.add_argument('-w', '--workers', type=int, default=1,
+                    help='The number of requests transcribed concurrently.')
+    p.add_argument('-q', '--max_queue', type=int, default=16,
+                    help='The number of requests allowed to wait before rejecting new ones.')
+    return p.parse_args()
+
+if __name__ == '__main__':
+    args = parser()
+    service = TranscriptionService(args.asc_model_fp, args.desc_model_fp, args.output_dir,
+                                   args.workers, args.max_queue)
+    serve(service, args.host, args.port, args.socket)